@@ -1,73 +1,306 @@
 #!/usr/bin/python3
 
 import numpy as np
+from scipy import sparse
 import nltk
 from gensim.models import Word2Vec
 from gensim.models import KeyedVectors
 import argparse
+import hashlib
 import json
 import logging
 import math
-import re
+import os
+import time
 from joblib import Parallel, delayed
 import multiprocessing
+from collections import Counter
+from filtering import LyricsFilter, LexiconFilter, filterSettings, mergeStats
+from filtering import statsSince
+from filtering import compareFilters, corpusLexicon, countTags
+from filtering import readLexicon, taggerLexicon, writeLexicon
+from tables import Table, TableWriter, VECTORS, DEVIATIONS, AVG_DEVIATIONS
+from tables import isTable, readTable, statsFile, tableFiles, TABLE_SUFFIX
+from store import CorpusStore, fileKey, modelKey, songKey, textKey
+from mobility import findMobility
+from similarity import findSimilar
+from correlation import correlate
+from representation import PRECISIONS, compareOutputs, projectionFile
+from representation import representVectors
+from tracing import tracer
 
 logging.basicConfig(
     format='%(asctime)s : %(levelname)s : %(message)s',
     level=logging.INFO
 )
 
+# Number of song chunks handed to each parallel job when filtering lyrics
+CHUNKS_PER_JOB = 4
+
+# Lyrics filters shared by all songs filtered in this process, by engine
+# and lexicon file
+lyrics_filters = {}
+
+# Filter engines: tagging lyrics with nltk, or looking words up in a lexicon
+FILTER_ENGINES = ["nltk", "lexicon"]
+
+# Filter engine and lexicon file (None for the tagger's) of this run
+filter_engine = "nltk"
+lexicon_file = None
+
+# Extension of merged datasets written one song per line
+JSON_LINES_SUFFIX = ".jsonl"
+
+# Extension of word vector files written by exportModel
+KEYED_VECTORS_SUFFIX = ".kv"
+
+# Word vectors loaded by this process, by file name
+models = {}
+
+# Vocabulary ids of the words of each model, by model id
+vocabularies = {}
+
+# Number of song vectors compared with their centers at a time
+DEVIATION_BLOCK = 4096
+
+# Stages that can be run out of core, a chunk of artists at a time
+CHUNKED_TYPES = [
+    "corpora", "vectors", "deviations", "overall_deviations", "avg_deviations"
+]
+
+
+def setFilterEngine(engine, lexicon=None):
+    '''
+    Selects the filter engine of this run
+    '''
+    global filter_engine, lexicon_file
+    if engine not in FILTER_ENGINES:
+        raise ValueError("Invalid filter engine: %s" % (engine))
+    filter_engine = engine
+    lexicon_file = lexicon
+
+
+def getFilter(engine=None, lexicon=None):
+    '''
+    Returns the lyrics filter of this process for an engine (by default
+    the one of this run), creating it on first use
+    '''
+    if engine is None:
+        (engine, lexicon) = (filter_engine, lexicon_file)
+    if (engine, lexicon) not in lyrics_filters:
+        if engine == "lexicon":
+            lyrics_filters[(engine, lexicon)] = LexiconFilter(
+                readLexicon(lexicon) if lexicon else None
+            )
+        else:
+            lyrics_filters[(engine, lexicon)] = LyricsFilter()
+    return lyrics_filters[(engine, lexicon)]
+
+
+def getFilterSettings():
+    '''
+    Fingerprint of the filter of this run, without loading the tagger when
+    it is not needed
+    '''
+    if filter_engine == "nltk":
+        return filterSettings()
+    return getFilter().settings()
+
 
 def filterSong(song):
     '''
     Filters out unwanted words (e.g. anything that isn't English,
     articles, etc.)
     '''
-    out = re.sub(
-        r"\.|\-|\(|\)|\–|\!|\?|\,", " ", song
-    )
-    tagged = nltk.pos_tag(nltk.word_tokenize(out))
-    discard_tags = [
-        "CC", "CD", "EX", "FW",
-        "IN", "LS", "MD", "PRP",
-        "PRP$", "TO", "UH", "SYM",
-        "WDT", "WP", "WP$", "WRB"
-    ]
-    out = " ".join(w[0] for w in tagged if w[1] not in discard_tags)
-    return out
+    return getFilter().filter(song)
 
 
-def getCorpus(artist, data):
-    corpus = []
+def filterChunk(lyrics, engine, lexicon):
+    '''
+    Filters a chunk of songs, used as the unit of work for parallel jobs.
+    The engine is passed along since workers do not share this run's
+    settings. Returns the filtered songs and the counters of the filter
+    for this chunk.
+    '''
+    f = getFilter(engine, lexicon)
+    before = f.stats()
+    filtered = f.filterBatch(lyrics)
+    return (filtered, statsSince(before, f.stats()))
+
+
+def indexSongs(artists, data):
+    '''
+    Groups the songs of the given artists by normalized artist name in a
+    single pass over the dataset. Returns the matching songs and a map from
+    normalized name to song indices.
+    '''
+    wanted = {artist["name"].lower() for artist in artists}
+    songs = []
+    index = {}
     for s in data:
-        if s["artist"].lower() == artist["name"].lower():
-            if len(filterSong(s["lyrics"])) > 0:
-                corpus.append({
-                    "title": s["title"].lower(),
-                    "lyrics": filterSong(s["lyrics"])
-                })
-    return (artist, corpus)
+        name = s["artist"].lower()
+        if name in wanted:
+            index.setdefault(name, []).append(len(songs))
+            songs.append(s)
+    return (songs, index)
 
 
-def getTexts(num_artists, artists_file, data_file):
+def filterLyrics(lyrics):
+    '''
+    Filters a list of songs in parallel jobs, each handling a chunk of songs
+    '''
+    n_jobs = multiprocessing.cpu_count()
+    chunk_size = max(1, math.ceil(len(lyrics) / (n_jobs * CHUNKS_PER_JOB)))
+    with tracer.span("filter") as span:
+        chunks = Parallel(
+            verbose=100, n_jobs=n_jobs
+        )(
+            delayed(filterChunk)(
+                lyrics[i:i + chunk_size], filter_engine, lexicon_file
+            ) for i in range(0, len(lyrics), chunk_size)
+        )
+        filtered = [song for (chunk, _) in chunks for song in chunk]
+        stats = mergeStats(s for (_, s) in chunks)
+        span.count(songs=len(filtered), tokens=stats["tokens"])
+        # Timed inside the workers, so summed over all of them
+        tracer.record(
+            "tokenize",
+            worker_seconds=stats["tokenize_seconds"],
+            tokens=stats["tokens"]
+        )
+        tracer.record(
+            "tag",
+            worker_seconds=stats["tag_seconds"],
+            tokens=stats["tokens"],
+            cache_hits=stats["hits"],
+            cache_misses=stats["misses"]
+        )
+    logging.info(
+        "Filtered %d songs (%.1f songs/s, %.1f tokens/s), "
+        "tag cache hit rate %.1f%%" % (
+            len(filtered), stats["songs_per_second"],
+            stats["tokens_per_second"], 100 * stats["hit_rate"]
+        )
+    )
+    return filtered
+
+
+def filterStored(lyrics, store):
+    '''
+    Filters a list of songs, only working on songs that are not in the store
+    '''
+    settings = getFilterSettings()
+    keys = [songKey(settings, song) for song in lyrics]
+    stored = store.getTokens(keys)
+    # Songs repeated in the dataset are filtered once but only count as
+    # found if they were stored before this run
+    found = sum(1 for key in keys if key in stored)
+    missing = {}
+    for (key, song) in zip(keys, lyrics):
+        if key not in stored:
+            missing[key] = song
+    logging.info(
+        "%d of %d songs found in the corpus store" % (found, len(lyrics))
+    )
+    if len(missing) > 0:
+        filtered = filterLyrics(list(missing.values()))
+        store.putTokens(zip(missing.keys(), filtered))
+        stored.update(zip(missing.keys(), filtered))
+    return [stored[key] for key in keys]
+
+
+def timeFilter(lexicon_filter, lyrics):
+    begin = time.perf_counter()
+    lexicon_filter.filterBatch(lyrics)
+    return time.perf_counter() - begin
+
+
+def filterAgreement(data_file, num_songs, out_lexicon=None):
+    '''
+    Measures how closely the lexicon filter follows the nltk tagger on the
+    songs of a dataset, and how much faster it is. The tagger's own
+    lexicon is checked on every song, while a lexicon derived from the
+    tagged songs is fitted on half of them and checked on the other half.
+    The lexicon derived from all songs is saved to out_lexicon if given.
+    '''
+    songs = readSongs(data_file)
+    lyrics = [song["lyrics"] for (_, song) in zip(range(num_songs), songs)]
+    tagger = LyricsFilter()
+    begin = time.perf_counter()
+    tagged = [tagger.tagged(song) for song in lyrics]
+    tagger_seconds = time.perf_counter() - begin
+    logging.info("Tagged %d songs in %.3fs" % (len(lyrics), tagger_seconds))
+    (fit, held_out) = (slice(0, None, 2), slice(1, None, 2))
+    cases = {
+        "tagger_lexicon": (
+            LexiconFilter(taggerLexicon(tagger=tagger.tagger)), slice(None)
+        ),
+        "corpus_lexicon": (
+            LexiconFilter(corpusLexicon(countTags(tagged[fit]))), held_out
+        ),
+    }
+    report = {"songs": len(lyrics), "nltk_seconds": tagger_seconds}
+    for (name, (lexicon_filter, songs)) in cases.items():
+        report[name] = compareFilters(
+            tagged[songs], lyrics[songs], lexicon_filter
+        )
+        seconds = timeFilter(lexicon_filter, lyrics)
+        report[name]["lexicon_seconds"] = seconds
+        report[name]["speedup"] = tagger_seconds / seconds if seconds else None
+        logging.info(
+            "%s: %.2f%% of tokens agree, %.2f%% of songs identical%s" % (
+                name, 100 * report[name]["agreement"],
+                100 * report[name]["identical_songs"],
+                ", %.1fx faster" % (report[name]["speedup"])
+                if report[name]["speedup"] is not None else ""
+            )
+        )
+    if out_lexicon:
+        lexicon = corpusLexicon(countTags(tagged))
+        writeLexicon(out_lexicon, lexicon)
+        logging.info(
+            "Lexicon of %d words written to %s" % (len(lexicon), out_lexicon)
+        )
+    return report
+
+
+def readSongs(data_file):
+    '''
+    Yields the songs of a merged dataset, either a JSON list or JSON Lines
+    '''
+    with open(data_file, "r") as df:
+        if data_file.endswith(JSON_LINES_SUFFIX):
+            for line in df:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(df)
+
+
+def getTexts(num_artists, artists_file, data_file, store=None):
     '''
     Formats song data in a way that can be better processed
     '''
     artists = []
-    data = []
     texts = []
-    with open(artists_file, "r") as af, open(data_file, "r") as df:
-        artists = json.load(af)
-        data = json.load(df)
-    corpora = Parallel(
-        verbose=100, n_jobs=multiprocessing.cpu_count()
-    )(
-        delayed(getCorpus)(
-            artist,
-            data
-        ) for artist in artists[:min(num_artists, len(artists))]
-    )
-    for (artist, corpus) in corpora:
+    with tracer.span("load") as span:
+        with open(artists_file, "r") as af:
+            artists = json.load(af)
+        artists = artists[:min(num_artists, len(artists))]
+        (songs, index) = indexSongs(artists, readSongs(data_file))
+        span.count(songs=len(songs))
+    if store is None:
+        lyrics = filterLyrics([s["lyrics"] for s in songs])
+    else:
+        lyrics = filterStored([s["lyrics"] for s in songs], store)
+    for artist in artists:
+        corpus = [
+            {
+                "title": songs[i]["title"].lower(),
+                "lyrics": lyrics[i]
+            } for i in index.get(artist["name"].lower(), [])
+            if len(lyrics[i]) > 0
+        ]
         if corpus != []:
             texts.append(
                 {
@@ -78,128 +311,818 @@ def getTexts(num_artists, artists_file, data_file):
     return texts
 
 
+def isKeyedVectors(model_file):
+    return model_file.endswith(KEYED_VECTORS_SUFFIX)
+
+
+def loadModel(model_file):
+    '''
+    Loads word vectors. Vectors exported with exportModel are memory mapped
+    read-only, anything else is loaded as a full Word2Vec model.
+    '''
+    logging.info("Loading vectors from %s" % (model_file))
+    if isKeyedVectors(model_file):
+        return KeyedVectors.load(model_file, mmap="r")
+    logging.warning(
+        "%s is a full Word2Vec model, export it with -t export_model "
+        "for faster loading" % (model_file)
+    )
+    return Word2Vec.load(model_file).wv
+
+
+def getModel(model_file):
+    '''
+    Returns the word vectors in model_file, loading them once per process
+    '''
+    if model_file not in models:
+        with tracer.span("load"):
+            models[model_file] = loadModel(model_file)
+    return models[model_file]
+
+
+def exportModel(model_file, out_file):
+    '''
+    Saves only the word vectors of a Word2Vec model, with the vector matrix
+    in its own .npy file so that it can be memory mapped
+    '''
+    if not out_file:
+        out_file = model_file + KEYED_VECTORS_SUFFIX
+    if not isKeyedVectors(out_file):
+        out_file += KEYED_VECTORS_SUFFIX
+    logging.info("Loading %s" % (model_file))
+    wv = Word2Vec.load(model_file).wv
+    logging.info("Writing vectors to %s..." % (out_file))
+    wv.save(out_file, separately=["vectors"])
+    logging.info("Vectors written to %s" % (out_file))
+    return out_file
+
+
+def getMeans(model_file, songs):
+    model = getModel(model_file)
+    return [
+        getGeometricCentre(
+            model=model, text=corpus["lyrics"]
+        ) for corpus in songs
+    ]
+
+
+def getVocabulary(model: KeyedVectors):
+    '''
+    Returns a map from each word of the model to its vocabulary id. gensim 4
+    keeps one as key_to_index, gensim 3 only has a vocab entry per word, so
+    the map is built once per model.
+    '''
+    if hasattr(model, "key_to_index"):
+        return model.key_to_index
+    if id(model) not in vocabularies:
+        # The model is kept along with its map so that its id is not reused
+        vocabularies[id(model)] = (
+            model, {word: v.index for (word, v) in model.vocab.items()}
+        )
+    return vocabularies[id(model)][1]
+
+
+def getIds(model: KeyedVectors, text):
+    '''
+    Vocabulary ids of the words of a filtered text that are in the model
+    '''
+    vocabulary = getVocabulary(model)
+    return np.array(
+        [vocabulary[word] for word in text.split(" ") if word in vocabulary],
+        dtype=np.int32
+    )
+
+
+def getSongIds(model_file, texts, store=None):
+    '''
+    Returns the vocabulary ids of every song of every artist. When a store
+    is given, words are only looked up for the songs that are not in it.
+    '''
+    model = getModel(model_file)
+    if store is None:
+        return [
+            [getIds(model, corpus["lyrics"]) for corpus in text["songs"]]
+            for text in texts
+        ]
+    model_key = modelKey(model_file)
+    keys = [
+        [textKey(corpus["lyrics"]) for corpus in text["songs"]]
+        for text in texts
+    ]
+    stored = store.getIds(model_key, [k for ks in keys for k in ks])
+    missing = {}
+    for (ks, text) in zip(keys, texts):
+        for (key, corpus) in zip(ks, text["songs"]):
+            if key not in stored and key not in missing:
+                missing[key] = getIds(model, corpus["lyrics"])
+    logging.info(
+        "%d new songs added to the corpus store" % (len(missing))
+    )
+    store.putIds(model_key, missing.items())
+    stored.update(missing)
+    return [[stored[key] for key in ks] for ks in keys]
+
+
+def getStoredMeans(model_file, texts, store):
+    '''
+    Works out the mean vector of each song from vocabulary ids, only looking
+    up words for the songs that are not in the store
+    '''
+    model = getModel(model_file)
+    return [
+        [
+            np.mean(model.vectors[ids], axis=0)
+            if len(ids) > 0 else -1 * np.ones(model.vector_size)
+            for ids in song_ids
+        ] for song_ids in getSongIds(model_file, texts, store)
+    ]
+
+
+def getSparseMeans(model_file, texts, store=None):
+    '''
+    Works out every song mean with a single product between a sparse
+    songs x vocabulary count matrix and the vectors of the words that
+    appear in the corpus, then every artist center with a second product.
+    Sums are carried out in double precision, so results can differ from
+    the dense engine in the last digits.
+    '''
+    model = getModel(model_file)
+    song_ids = [ids for a in getSongIds(model_file, texts, store) for ids in a]
+    counts = [len(text["songs"]) for text in texts]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    lengths = np.array([len(ids) for ids in song_ids], dtype=np.int64)
+    ids = np.concatenate(song_ids + [np.empty(0, dtype=np.int32)])
+    # Only the vectors of words that appear in the corpus are needed
+    (vocabulary, columns) = np.unique(ids, return_inverse=True)
+    bag = sparse.csr_matrix(
+        (
+            np.ones(len(ids)),
+            columns.ravel(),
+            np.concatenate(([0], np.cumsum(lengths)))
+        ),
+        shape=(len(song_ids), len(vocabulary))
+    )
+    bag.sum_duplicates()
+    sums = bag @ np.asarray(model.vectors[vocabulary], dtype=np.float64)
+    means = np.full((len(song_ids), model.vector_size), -1.0)
+    found = lengths > 0
+    means[found] = sums[found] / lengths[found, np.newaxis]
+    means = means.astype(np.float32)
+    owners = np.repeat(np.arange(len(texts)), counts)
+    artists = sparse.csr_matrix(
+        (1.0 / np.asarray(counts)[owners], (owners, np.arange(len(owners)))),
+        shape=(len(texts), len(song_ids))
+    )
+    centers = np.asarray(artists @ means.astype(np.float64), dtype=np.float32)
+    return (
+        [means[offsets[i]:offsets[i + 1]] for i in range(len(texts))],
+        list(centers)
+    )
+
+
 def getGeometricCentre(model: KeyedVectors, text):
-    doc = [word for word in text.split(" ") if word in model.vocab]
+    vocabulary = getVocabulary(model)
+    doc = [word for word in text.split(" ") if word in vocabulary]
     if len(doc) == 0:
         return -1 * np.ones(len(model["hello"]))
     return np.mean(model[doc], axis=0)
 
 
+def rowDistances(visited, centers):
+    '''
+    Sum of the absolute differences between each row and its center. The
+    cumulative sum adds the dimensions in order, so results are bit for bit
+    the same as summing them one at a time in Python.
+    '''
+    distances = np.abs(visited - centers)
+    if distances.shape[1] == 0:
+        return np.zeros(distances.shape[0])
+    return np.cumsum(distances, axis=1)[:, -1]
+
+
 def standardDeviation(center_of_mass, visited, visits):
-    return [
-        [
-            math.sqrt(
-                sum(
-                    [
-                        abs(
-                            r[i] - center_of_mass[i]
-                        ) for i in range(len(center_of_mass))
-                    ],
-                    0
-                )/visits
-            )
-        ] for r in visited
-    ]
+    visited = np.asarray(visited, dtype=np.float64).reshape(
+        -1, len(center_of_mass)
+    )
+    return np.sqrt(
+        rowDistances(visited, np.asarray(center_of_mass, dtype=np.float64))
+        / visits
+    )[:, np.newaxis].tolist()
+
+
+def blockDeviations(matrix, centers, owners, visits):
+    '''
+    Works out the deviation of every row of matrix from centers[owners[row]],
+    a block of rows at a time to bound memory (and reads of mapped files)
+    '''
+    out = np.empty(len(matrix))
+    for i in range(0, len(matrix), DEVIATION_BLOCK):
+        out[i:i + DEVIATION_BLOCK] = rowDistances(
+            np.asarray(matrix[i:i + DEVIATION_BLOCK], dtype=np.float64),
+            centers[owners[i:i + DEVIATION_BLOCK]]
+        )
+    return np.sqrt(out / visits)
+
+
+def asTable(data):
+    return data if isinstance(data, Table) else Table.fromJson(data)
 
 
-def findCorpora(model_file, artists_file, num_artists, data_file):
+def openStore(store_file):
+    if not store_file:
+        return None
+    logging.info("Using corpus store %s" % (store_file))
+    return CorpusStore(store_file)
+
+
+def findCorpora(
+    model_file, artists_file, num_artists, data_file, store_file=None
+):
     nltk.download("punkt")
     nltk.download("averaged_perceptron_tagger")
     logging.info("Extracting vectors")
     return getTexts(
         num_artists=num_artists,
         artists_file=artists_file,
-        data_file=data_file
+        data_file=data_file,
+        store=openStore(store_file)
     )
 
 
-def findVectors(model_file, artists_file, num_artists, data_file):
+def vectorsProducer(model_file, engine):
+    '''
+    Identifies what song vectors are worked out with: the model, the
+    vectors engine and the lyrics filter
+    '''
+    return [modelKey(model_file), engine, getFilterSettings()]
+
+
+def findVectors(
+    model_file,
+    artists_file,
+    num_artists,
+    data_file,
+    store_file=None,
+    engine="dense",
+    previous_file=None
+):
     '''
     Works out the geometric center of each artist as well as the mean
-    vector means of each song
+    vector means of each song. When previous_file is a vectors table saved
+    with summary statistics by the same model, engine and filter, it is
+    updated instead.
     '''
     artists = []
     texts = []
     with open(artists_file, "r") as af, open(data_file, "r") as df:
         texts = json.load(df)
         artists = json.load(af)[:len(texts)]
-    # Load keyed wikipedia vector model
-    logging.info("Loading vectors")
-    model = Word2Vec.load(model_file).wv
+    if previous_file and isTable(previous_file) and \
+            os.path.exists(statsFile(previous_file)):
+        previous = Table.load(previous_file, mmap=False)
+        producer = vectorsProducer(model_file, engine)
+        if previous.stats.get("producer") == producer:
+            logging.info("Updating %s" % (previous_file))
+            return updateVectors(
+                model_file, artists, texts, num_artists, previous, producer
+            )
+        logging.warning(
+            "%s was worked out with a different model, engine or filter, "
+            "working out all vectors again" % (previous_file)
+        )
+    return getVectors(
+        model_file, artists, texts, num_artists, store_file, engine
+    )
+
+
+def getVectors(
+    model_file, artists, texts, num_artists, store_file=None, engine="dense"
+):
     logging.info("Working out means")
-    means = [
-        [
-            getGeometricCentre(
-                model=model, text=corpus["lyrics"]
-            )for corpus in text["songs"]
-        ] for text in texts
-    ]
-    logging.info("Working out centers")
-    centers = [
-        np.mean(m, axis=0) for m in means
+    with tracer.span("embed") as span:
+        if engine == "sparse":
+            # Centers are worked out along with the means
+            (means, centers) = getSparseMeans(
+                model_file, texts, openStore(store_file)
+            )
+        elif store_file:
+            means = getStoredMeans(model_file, texts, openStore(store_file))
+        elif isKeyedVectors(model_file):
+            # Every worker maps the same vectors file, sharing the page cache
+            means = Parallel(
+                verbose=100, n_jobs=multiprocessing.cpu_count()
+            )(
+                delayed(getMeans)(
+                    model_file, text["songs"]
+                ) for text in texts
+            )
+        else:
+            means = [getMeans(model_file, text["songs"]) for text in texts]
+    if tracer.enabled:
+        span.count(**countWords(model_file, texts))
+    with tracer.span("reduce"):
+        if engine != "sparse":
+            logging.info("Working out centers")
+            centers = [
+                np.mean(m, axis=0) for m in means
+            ]
+        num = min(num_artists, len(artists))
+        # Artists without songs have no corpus, so names are taken from the
+        # corpora rather than the artists file
+        vectors = Table.fromRows(
+            VECTORS,
+            [texts[i]["artist"] for i in range(num)],
+            [means[i] for i in range(num)],
+            centers=[centers[i] for i in range(num)],
+            titles=[
+                [corpus["title"] for corpus in texts[i]["songs"]]
+                for i in range(num)
+            ]
+        )
+        vectors.stats = {
+            "sums": np.array(
+                [vectors.rows(i).sum(axis=0) for i in range(num)]
+            ).reshape(num, vectors.matrix.shape[1]),
+            "keys": [key for text in texts[:num] for key in songKeys(text)],
+            "changed": list(vectors.names),
+            "producer": vectorsProducer(model_file, engine)
+        }
+    return vectors
+
+
+def countWords(model_file, texts):
+    '''
+    Counts the songs and words of the corpora, and the words that are not
+    in the model, for traces
+    '''
+    vocab = getVocabulary(getModel(model_file))
+    counts = {"songs": 0, "tokens": 0, "oov": 0}
+    for text in texts:
+        for corpus in text["songs"]:
+            words = corpus["lyrics"].split(" ")
+            counts["songs"] += 1
+            counts["tokens"] += len(words)
+            counts["oov"] += sum(1 for word in words if word not in vocab)
+    return counts
+
+
+def songKeys(text):
+    '''
+    Keys identifying each song of an artist's corpus, used to tell which
+    songs were added or removed between runs
+    '''
+    return [
+        textKey(corpus["title"] + "\0" + corpus["lyrics"])
+        for corpus in text["songs"]
     ]
+
+
+def updateVectors(
+    model_file, artists, texts, num_artists, previous, producer
+):
+    '''
+    Updates a vectors table with summary statistics to a new corpus. Only
+    the means of added songs are worked out, and the centers of artists
+    whose songs changed are refreshed from their vector sums. Other artists
+    are copied over.
+    '''
+    index = {name: i for (i, name) in enumerate(previous.names)}
+    num = min(num_artists, len(artists))
+    rows = []
+    centers = []
+    sums = []
+    keys = []
+    changed = []
+    for i in range(num):
+        name = texts[i]["artist"]
+        new_keys = songKeys(texts[i])
+        j = index.get(name)
+        old_keys = [] if j is None else previous.stats["keys"][
+            previous.offsets[j]:previous.offsets[j + 1]
+        ]
+        keys.extend(new_keys)
+        if old_keys == new_keys:
+            rows.append(previous.rows(j))
+            centers.append(previous.centers[j])
+            sums.append(previous.stats["sums"][j])
+            continue
+        old = {} if j is None else dict(zip(old_keys, previous.rows(j)))
+        added = [
+            corpus for (key, corpus) in zip(new_keys, texts[i]["songs"])
+            if key not in old
+        ]
+        means = iter(getMeans(model_file, added))
+        artist_rows = [
+            old[key] if key in old else np.asarray(next(means), np.float64)
+            for key in new_keys
+        ]
+        if j is None:
+            total = np.sum(artist_rows, axis=0)
+        else:
+            total = np.array(previous.stats["sums"][j], dtype=np.float64)
+            (before, after) = (Counter(old_keys), Counter(new_keys))
+            for (key, count) in (before - after).items():
+                total -= count * old[key]
+            for (key, count) in (after - before).items():
+                total += count * artist_rows[new_keys.index(key)]
+        rows.append(artist_rows)
+        centers.append(total / len(new_keys))
+        sums.append(total)
+        changed.append(name)
+    logging.info(
+        "%d of %d artists changed" % (len(changed), num)
+    )
+    vectors = Table.fromRows(
+        VECTORS,
+        [texts[i]["artist"] for i in range(num)],
+        rows,
+        centers=centers,
+        titles=[
+            [corpus["title"] for corpus in texts[i]["songs"]]
+            for i in range(num)
+        ]
+    )
+    vectors.stats = {
+        "sums": np.array(sums, dtype=np.float64).reshape(
+            num, vectors.matrix.shape[1]
+        ),
+        "keys": keys,
+        "changed": changed,
+        "producer": producer
+    }
+    return vectors
+
+
+def deviationVersions(vectors, centers):
+    '''
+    Hashes the song keys of each artist along with the center their
+    deviations are measured from. Deviations saved with the same version
+    were worked out from the same songs and center, whichever run wrote
+    the vectors. Returns None for vectors without song keys.
+    '''
+    if vectors.stats is None:
+        return None
+    keys = vectors.stats["keys"]
     return [
-        {
-            "artist": artists[i]["name"],
-            "center": centers[i].tolist(),
-            "vectors": [m.tolist() for m in means[i]]
-        } for i in range(min(num_artists, len(artists)))
+        hashlib.sha1(
+            "\0".join(
+                keys[vectors.offsets[i]:vectors.offsets[i + 1]]
+            ).encode("utf-8") +
+            np.ascontiguousarray(centers[i], dtype=np.float64).tobytes()
+        ).hexdigest() for i in range(len(vectors))
     ]
 
 
-def findDeviation(vectors):
-    logging.info("Running standard deviation analysis")
-    return Parallel(
-        verbose=100, n_jobs=multiprocessing.cpu_count(), prefer="threads"
-    )(
-        delayed(
-            lambda i: {
-                "name": vectors[i]["artist"],
-                "deviations": standardDeviation(
-                    center_of_mass=vectors[i]["center"],
-                    visited=vectors[i]["vectors"],
-                    visits=1
-                )
-            }
-        )(i) for i in range(len(vectors))
+def reusedDeviations(vectors, versions, previous):
+    '''
+    Returns the deviations of a previous run whose version matches, and a
+    mask of the songs that still have to be worked out
+    '''
+    deviations = np.empty(len(vectors.matrix))
+    todo = np.ones(len(vectors.matrix), dtype=bool)
+    if previous is None or versions is None or previous.stats is None or \
+            "versions" not in previous.stats:
+        return (deviations, todo)
+    index = {
+        version: j for (j, version) in enumerate(previous.stats["versions"])
+    }
+    for (i, version) in enumerate(versions):
+        j = index.get(version)
+        if j is None:
+            continue
+        rows = slice(vectors.offsets[i], vectors.offsets[i + 1])
+        deviations[rows] = previous.rows(j)[:, 0]
+        todo[rows] = False
+    logging.info(
+        "Reusing deviations of %d of %d songs" %
+        (len(todo) - np.count_nonzero(todo), len(todo))
+    )
+    return (deviations, todo)
+
+
+def deviationsTable(vectors, deviations, versions):
+    return Table(
+        DEVIATIONS,
+        vectors.names,
+        vectors.offsets,
+        deviations[:, np.newaxis],
+        titles=vectors.titles,
+        stats={"versions": versions} if versions is not None else None
     )
 
 
-def findOverallDeviation(vectors):
+def findDeviation(vectors, previous=None):
+    '''
+    Works out the deviation of each song from its artist's center. With the
+    previous output, the deviations of artists whose songs and center are
+    unchanged are reused.
+    '''
+    logging.info("Running standard deviation analysis")
+    vectors = asTable(vectors)
+    owners = np.repeat(np.arange(len(vectors)), vectors.counts())
+    versions = deviationVersions(vectors, vectors.centers)
+    (deviations, todo) = reusedDeviations(vectors, versions, previous)
+    with tracer.span("reduce") as span:
+        deviations[todo] = blockDeviations(
+            vectors.matrix[todo] if not todo.all() else vectors.matrix,
+            np.asarray(vectors.centers, dtype=np.float64),
+            owners[todo],
+            visits=1
+        )
+        span.count(songs=int(np.count_nonzero(todo)))
+    return deviationsTable(vectors, deviations, versions)
+
+
+def overallCenter(parts):
+    '''
+    Mean of the centers of the artists of every part of a table. Centers are
+    added one artist at a time, so a table gets the same center whether it
+    is read whole or in parts.
+    '''
+    (total, count) = (None, 0)
+    for part in parts:
+        centers = np.asarray(part.centers, dtype=np.float64)
+        if total is None:
+            total = np.zeros(centers.shape[1])
+        for center in centers:
+            total += center
+        count += len(centers)
+    return total / count
+
+
+def findOverallDeviation(vectors, previous=None, overall_center=None):
+    '''
+    Works out the deviation of each song from the center of all artists,
+    or from overall_center when given (e.g. for a part of a table). Any
+    change to an artist moves that center, so previous output is only
+    reused for artists whose songs are unchanged when the center is too.
+    '''
     logging.info("Running overall deviation analysis")
-    overall_center = np.mean(
-        [v["center"] for v in vectors], axis=0
-    )
-    return Parallel(
-        verbose=100, n_jobs=multiprocessing.cpu_count(), prefer="threads"
-    )(
-        delayed(
-            lambda i: {
-                "name": vectors[i]["artist"],
-                "deviations": standardDeviation(
-                    center_of_mass=overall_center,
-                    visited=vectors[i]["vectors"],
-                    visits=1
-                )
-            }
-        )(i) for i in range(len(vectors))
+    vectors = asTable(vectors)
+    if overall_center is None:
+        overall_center = overallCenter([vectors])
+    versions = deviationVersions(
+        vectors, np.broadcast_to(overall_center, vectors.centers.shape)
     )
+    (deviations, todo) = reusedDeviations(vectors, versions, previous)
+    with tracer.span("reduce") as span:
+        deviations[todo] = blockDeviations(
+            vectors.matrix[todo] if not todo.all() else vectors.matrix,
+            overall_center[np.newaxis],
+            np.zeros(int(np.count_nonzero(todo)), dtype=np.int64),
+            visits=1
+        )
+        span.count(songs=int(np.count_nonzero(todo)))
+    return deviationsTable(vectors, deviations, versions)
 
 
 def averageDeviation(deviations):
     logging.info("Running average deviation analysis")
-    return [
-        {
-            "name": artist["name"],
-            "average_deviation": np.mean(artist["deviations"], axis=0).tolist()
-        } for artist in deviations
-    ]
+    deviations = asTable(deviations)
+    with tracer.span("reduce") as span:
+        averages = np.array(
+            [
+                np.mean(
+                    np.asarray(deviations.rows(i), dtype=np.float64), axis=0
+                ) for i in range(len(deviations))
+            ],
+            dtype=np.float64
+        ).reshape(len(deviations), -1)
+        span.count(songs=len(deviations.matrix))
+    return Table(
+        AVG_DEVIATIONS,
+        deviations.names,
+        np.arange(len(deviations) + 1),
+        averages
+    )
+
+
+def indexLines(artists, data_file):
+    '''
+    Finds the songs of the given artists in a JSON Lines dataset in a
+    single pass, returning the byte offset of each song's line by
+    normalized artist name
+    '''
+    wanted = {artist["name"].lower() for artist in artists}
+    index = {}
+    with open(data_file, "rb") as df:
+        offset = 0
+        for line in df:
+            if line.strip():
+                name = json.loads(line)["artist"].lower()
+                if name in wanted:
+                    index.setdefault(name, []).append(offset)
+            offset += len(line)
+    return index
+
+
+def readLines(data_file, offsets):
+    with open(data_file, "rb") as df:
+        for offset in offsets:
+            df.seek(offset)
+            yield json.loads(df.readline())
+
+
+def getChunkedTexts(num_artists, artists_file, data_file, chunk, store=None):
+    '''
+    Yields the same texts as getTexts, filtering the songs of chunk
+    artists at a time. Songs of JSON Lines datasets are read from disk as
+    each chunk needs them, other datasets have to be loaded whole.
+    '''
+    with open(artists_file, "r") as af:
+        artists = json.load(af)
+    artists = artists[:min(num_artists, len(artists))]
+    if data_file.endswith(JSON_LINES_SUFFIX):
+        index = indexLines(artists, data_file)
+
+        def read(entries):
+            return list(readLines(data_file, sorted(entries)))
+    else:
+        logging.warning(
+            "%s is not JSON Lines, loading it whole" % (data_file)
+        )
+        (songs, index) = indexSongs(artists, readSongs(data_file))
+
+        def read(entries):
+            return [songs[i] for i in sorted(entries)]
+    for start in range(0, len(artists), chunk):
+        part = artists[start:start + chunk]
+        names = {artist["name"].lower() for artist in part}
+        entries = [e for name in names for e in index.get(name, [])]
+        chunk_songs = read(set(entries))
+        position = {e: i for (i, e) in enumerate(sorted(set(entries)))}
+        raw = [s["lyrics"] for s in chunk_songs]
+        if store is None:
+            lyrics = filterLyrics(raw)
+        else:
+            lyrics = filterStored(raw, store)
+        for artist in part:
+            corpus = [
+                {
+                    "title": chunk_songs[position[e]]["title"].lower(),
+                    "lyrics": lyrics[position[e]]
+                } for e in index.get(artist["name"].lower(), [])
+                if len(lyrics[position[e]]) > 0
+            ]
+            if corpus != []:
+                yield {
+                    "artist": artist["name"],
+                    "songs": corpus,
+                }
+
+
+def writeChunkedCorpora(
+    artists_file,
+    num_artists,
+    data_file,
+    out_file,
+    chunk,
+    store_file=None
+):
+    '''
+    Writes the corpora of chunk artists at a time as JSON Lines
+    '''
+    nltk.download("punkt")
+    nltk.download("averaged_perceptron_tagger")
+    logging.info("Extracting vectors in chunks of %d artists" % (chunk))
+    with open(out_file, "w") as of:
+        for text in getChunkedTexts(
+            num_artists, artists_file, data_file, chunk, openStore(store_file)
+        ):
+            of.write(json.dumps(text) + "\n")
+
+
+def writeChunkedVectors(
+    model_file,
+    artists_file,
+    num_artists,
+    data_file,
+    out_file,
+    chunk,
+    store_file=None,
+    engine="dense"
+):
+    '''
+    Works out the vectors of chunk artists at a time, writing them to a
+    binary table. Texts are streamed from the corpora file twice: once to
+    size the table, then to fill it.
+    '''
+    counts = [len(text["songs"]) for text in readSongs(data_file)]
+    with open(artists_file, "r") as af:
+        artists = json.load(af)[:len(counts)]
+    num = min(num_artists, len(artists))
+    writer = TableWriter(
+        out_file,
+        VECTORS,
+        num,
+        sum(counts[:num]),
+        getModel(model_file).vector_size
+    )
+    texts = readSongs(data_file)
+    for start in range(0, num, chunk):
+        part = [next(texts) for _ in range(min(chunk, num - start))]
+        logging.info(
+            "Artists %d to %d of %d" % (start + 1, start + len(part), num)
+        )
+        writer.append(getVectors(
+            model_file,
+            artists[start:start + len(part)],
+            part,
+            len(part),
+            store_file,
+            engine
+        ))
+    with tracer.span("serialize"):
+        return writer.close()
+
+
+def writeChunkedAnalysis(analysis_type, table, out_file, chunk):
+    '''
+    Runs a deviations analysis on chunk artists of a binary table at a
+    time, writing each chunk's output as soon as it is worked out. The
+    center of all artists is summed up in a first pass over the centers.
+    '''
+    if analysis_type == "avg_deviations":
+        writer = TableWriter(
+            out_file, AVG_DEVIATIONS, len(table), len(table),
+            table.matrix.shape[1]
+        )
+        analysis = averageDeviation
+    else:
+        writer = TableWriter(
+            out_file, DEVIATIONS, len(table), len(table.matrix), 1
+        )
+        analysis = findDeviation
+    if analysis_type == "overall_deviations":
+        overall_center = overallCenter(table.parts(chunk))
+
+        def overallDeviation(part):
+            return findOverallDeviation(part, overall_center=overall_center)
+        analysis = overallDeviation
+    for part in table.parts(chunk):
+        writer.append(analysis(part))
+    with tracer.span("serialize"):
+        return writer.close()
+
+
+def runChunked(
+    analysis_type,
+    model_file,
+    artists_file,
+    num_artists,
+    data_file,
+    out_file,
+    chunk,
+    store_file=None,
+    engine="dense"
+):
+    '''
+    Runs a stage out of core. Output is written as it is worked out, so it
+    has to be JSON Lines for corpora and a binary table otherwise.
+    '''
+    if out_file is None:
+        return
+    if analysis_type == "corpora":
+        if not out_file.endswith(JSON_LINES_SUFFIX):
+            logging.error("Chunked corpora are written as JSON Lines")
+            return
+        writeChunkedCorpora(
+            artists_file, num_artists, data_file, out_file, chunk, store_file
+        )
+    elif not isTable(out_file):
+        logging.error("Chunked output is written as a binary table")
+        return
+    elif analysis_type == "vectors":
+        writeChunkedVectors(
+            model_file,
+            artists_file,
+            num_artists,
+            data_file,
+            out_file,
+            chunk,
+            store_file,
+            engine
+        )
+    else:
+        writeChunkedAnalysis(
+            analysis_type, readTable(data_file), out_file, chunk
+        )
+    logging.info("Data written to %s" % (out_file))
 
 
 def writeToOut(out_file, data):
     '''
     Support function for file output
     '''
+    out_file = confirmOut(out_file)
+    if out_file is not None:
+        saveOutput(out_file, data)
+
+
+def confirmOut(out_file):
+    '''
+    Asks where output should be written, returning None if cancelled
+    '''
     if not out_file:
         out_file = input("Output file: ")
     confirm = input(
@@ -209,18 +1132,193 @@ def writeToOut(out_file, data):
     while confirm != "y":
         if confirm == "cancel":
             logging.warning("Aborting operation. No data was written to file.")
-            return
+            return None
         out_file = input("Output file: ")
         confirm = input(
             "Data will be written to %s. Confirm? [y/N/cancel] " %
             (out_file)
         ).lower()
-    with open(out_file, "w") as of:
+    return out_file
+
+
+def saveOutput(out_file, data):
+    '''
+    Writes a stage's output, as a binary table if out_file ends in .npy
+    '''
+    logging.info(
+        "Writing data to %s..." % (out_file)
+    )
+    with tracer.span("serialize"):
+        if isinstance(data, Table) and isTable(out_file):
+            data.save(out_file)
+        else:
+            with open(out_file, "w") as of:
+                json.dump(
+                    data.toJson() if isinstance(data, Table) else data, of
+                )
+    logging.info("Data written to %s" % (out_file))
+
+
+def readPrevious(out_file, update):
+    '''
+    Loads the binary output of a previous run, to be updated in place
+    '''
+    if not update or not out_file or not isTable(out_file) or \
+            not os.path.exists(tableFiles(out_file)[2]):
+        return None
+    return Table.load(out_file, mmap=False)
+
+
+def stageKey(stage, *parts):
+    return hashlib.sha1(
+        "\0".join((stage,) + parts).encode("utf-8")
+    ).hexdigest()
+
+
+def runStage(cache_dir, stage, key, compute):
+    '''
+    Returns the output of a pipeline stage, reading it from the cache when a
+    previous run had the same key and saving it there otherwise
+    '''
+    suffix = ".json" if stage == "corpora" else TABLE_SUFFIX
+    path = os.path.join(cache_dir, "%s-%s%s" % (stage, key, suffix))
+    # Sidecars are written last, so they mark complete tables
+    marker = path if stage == "corpora" else tableFiles(path)[2]
+    if os.path.exists(marker):
+        logging.info("Found %s in cache, skipping stage" % (stage))
+        if stage == "corpora":
+            with open(path, "r") as cf:
+                return json.load(cf)
+        return readTable(path)
+    with tracer.span(stage):
+        data = compute()
+        saveOutput(path, data)
+    return data
+
+
+def compareRepresentation(full, outputs):
+    '''
+    Reports how much the deviations stages of a pipeline run on reduced
+    vectors differ from the same stages on the full precision vectors
+    '''
+    report = {
+        "dimension": int(full.matrix.shape[1]),
+        "reduced_dimension": int(outputs["vectors"].matrix.shape[1]),
+        "dtype": str(outputs["vectors"].matrix.dtype),
+    }
+    for (stage, average) in (
+        ("deviations", "avg_deviations"),
+        ("overall_deviations", "overall_avg_deviations"),
+    ):
+        analysis = findDeviation if stage == "deviations" \
+            else findOverallDeviation
+        deviations = analysis(full)
+        report[stage] = compareOutputs(deviations, outputs[stage])
+        report[average] = compareOutputs(
+            averageDeviation(deviations), outputs[average]
+        )
         logging.info(
-            "Writing data to %s..." % (out_file)
+            "%s: max difference %.3g, rank correlation of averages %.4f" % (
+                stage, report[stage]["max_abs"],
+                report[average]["rank_correlation"]
+            )
         )
-        json.dump(data, of)
-    logging.info("Data written to %s" % (out_file))
+    return report
+
+
+def runPipeline(
+    model_file,
+    artists_file,
+    num_artists,
+    data_file,
+    config_file,
+    cache_dir,
+    out_dir=None,
+    store_file=None,
+    engine="dense",
+    precision="float64",
+    components=None
+):
+    '''
+    Runs every analysis stage in one process, keeping results in memory.
+    Each stage is cached under a hash of its inputs, the configuration and
+    the model, so unchanged stages are skipped on later runs. With a
+    reduced precision or a PCA projection, deviations are worked out on
+    the reduced vectors and compared with the full precision ones.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    config = ""
+    if os.path.exists(config_file):
+        with open(config_file, "r") as cf:
+            config = cf.read()
+    keys = {}
+    keys["corpora"] = stageKey(
+        "corpora",
+        config,
+        fileKey(data_file),
+        fileKey(artists_file),
+        str(num_artists),
+        getFilterSettings()
+    )
+    corpora = runStage(
+        cache_dir, "corpora", keys["corpora"],
+        lambda: findCorpora(
+            model_file, artists_file, num_artists, data_file, store_file
+        )
+    )
+    keys["vectors"] = stageKey(
+        "vectors", keys["corpora"], modelKey(model_file), engine
+    )
+
+    def vectors():
+        with open(artists_file, "r") as af:
+            artists = json.load(af)[:len(corpora)]
+        return getVectors(
+            model_file, artists, corpora, num_artists, store_file, engine
+        )
+
+    outputs = {}
+    outputs["corpora"] = corpora
+    outputs["vectors"] = runStage(
+        cache_dir, "vectors", keys["vectors"], vectors
+    )
+    full = None
+    if precision != "float64" or components:
+        full = outputs["vectors"]
+        source = keys["vectors"]
+        keys["vectors"] = stageKey(
+            "represented", source, precision, str(components)
+        )
+        outputs["vectors"] = runStage(
+            cache_dir, "represented", keys["vectors"],
+            lambda: representVectors(
+                full,
+                precision,
+                components,
+                os.path.join(cache_dir, "pca-%s.npz" % (source)),
+                source
+            )
+        )
+    for (stage, source, analysis) in (
+        ("deviations", "vectors", findDeviation),
+        ("avg_deviations", "deviations", averageDeviation),
+        ("overall_deviations", "vectors", findOverallDeviation),
+        ("overall_avg_deviations", "overall_deviations", averageDeviation),
+    ):
+        keys[stage] = stageKey(stage, keys[source])
+        outputs[stage] = runStage(
+            cache_dir, stage, keys[stage],
+            lambda: analysis(outputs[source])
+        )
+    if full is not None:
+        outputs["representation"] = compareRepresentation(full, outputs)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+        for (stage, data) in outputs.items():
+            suffix = ".json" if stage in ("corpora", "representation") or \
+                stage.endswith("avg_deviations") else TABLE_SUFFIX
+            saveOutput(os.path.join(out_dir, stage + suffix), data)
+    return outputs
 
 
 def main():
@@ -233,11 +1331,85 @@ def main():
     parser.add_argument("-d", "--data", help="Data file")
     parser.add_argument("-c", "--config", help="Config file")
     parser.add_argument("-o", "--out", help="Output file")
+    parser.add_argument("-s", "--store", help="Corpus store file")
+    parser.add_argument(
+        "-e", "--engine", help="Vectors engine (dense, sparse)"
+    )
+    parser.add_argument("-k", "--cache", help="Pipeline cache folder")
+    parser.add_argument(
+        "--precision",
+        help="Storage of vectors (%s)" % (", ".join(PRECISIONS))
+    )
+    parser.add_argument("--pca", help="Project vectors to PCA components")
+    parser.add_argument(
+        "-b", "--chunk", help="Artists processed at a time, out of core"
+    )
+    parser.add_argument(
+        "-u",
+        "--update",
+        action="store_true",
+        help="Update the binary output of a previous run"
+    )
+    parser.add_argument("--trace", help="Write a JSON trace of the run")
+    parser.add_argument(
+        "--profile",
+        help="Comma separated steps to run under cProfile, or all " +
+        "(needs --trace)"
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Trace the peak memory allocated by each step"
+    )
+    parser.add_argument(
+        "-q",
+        "--query",
+        action="append",
+        help="Artist or artist/title to find similar ones of, repeatable"
+    )
+    parser.add_argument("--top", help="Number of similar results")
+    parser.add_argument(
+        "--index", help="Similarity index (default next to the vectors)"
+    )
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="Search similar vectors with random projection hashes"
+    )
+    parser.add_argument(
+        "--evaluate",
+        action="store_true",
+        help="Report recall and latency of the approximate search"
+    )
+    parser.add_argument(
+        "--filter",
+        help="Filter engine (%s)" % (", ".join(FILTER_ENGINES))
+    )
+    parser.add_argument(
+        "--lexicon",
+        help="Lexicon of the lexicon filter (default the tagger's)"
+    )
+    parser.add_argument(
+        "--lexicon-out",
+        help="File to write the lexicon derived by filter_agreement to"
+    )
+    parser.add_argument(
+        "--resamples",
+        help="Permutations and bootstrap samples of correlations"
+    )
+    parser.add_argument("--seed", help="Random seed of the resamples")
+    parser.add_argument("-p", "--path", help="Weekly charts folder")
+    parser.add_argument("-w", "--window", help="Mobility window in weeks")
+    parser.add_argument(
+        "--centers", help="Binary table of the centers of mobility windows"
+    )
     parser.add_argument(
         "-t",
         "--atype",
         help="Analysis type " +
-        "(corpora, vectors, deviations, overall_deviations, avg_deviations)"
+        "(corpora, vectors, deviations, overall_deviations, avg_deviations, " +
+        "export_model, convert, pipeline, mobility, similar, " +
+        "filter_agreement, correlate)"
     )
     args = parser.parse_args()
 
@@ -247,6 +1419,14 @@ def main():
     num_artists = int(args.num) if args.num else 15
     analysis_type = args.atype if args.atype else "deviations"
     config_file = args.config if args.config else "./config.json"
+    store_file = args.store
+    engine = args.engine if args.engine else "dense"
+    cache_dir = args.cache if args.cache else "./cache"
+    chunk = int(args.chunk) if args.chunk else None
+    precision = args.precision if args.precision else "float64"
+    components = int(args.pca) if args.pca else None
+    engine_filter = args.filter if args.filter else "nltk"
+    lexicon = args.lexicon
     config = []
     logging.info("Attempting to read configuration from %s..." % (config_file))
     try:
@@ -257,39 +1437,161 @@ def main():
         artists_file = args.artists if args.artists else config["artists_file"]
         num_artists = int(args.num) if args.num else config["num_artists"]
         analysis_type = args.atype if args.atype else config["analysis_type"]
+        store_file = args.store if args.store else config.get("store_file")
+        engine = args.engine if args.engine else \
+            config.get("vectors_engine", "dense")
+        cache_dir = args.cache if args.cache else \
+            config.get("cache_dir", "./cache")
+        chunk = int(args.chunk) if args.chunk else \
+            config.get("chunk_artists")
+        precision = args.precision if args.precision else \
+            config.get("vectors_precision", "float64")
+        components = int(args.pca) if args.pca else \
+            config.get("pca_components")
+        engine_filter = args.filter if args.filter else \
+            config.get("filter_engine", "nltk")
+        lexicon = args.lexicon if args.lexicon else config.get("lexicon_file")
         logging.info("Configuration read from %s" % (config_file))
     except IOError:
         logging.warning(
             "Could not read %s"
             % (config_file)
         )
+    if args.trace:
+        tracer.enable(
+            args.trace,
+            args.profile.split(",") if args.profile else (),
+            args.trace_memory,
+            analysis_type
+        )
+    if analysis_type != "filter_agreement":
+        setFilterEngine(engine_filter, lexicon)
 
-    if analysis_type == "corpora":
-        corpora = findCorpora(model_file, artists_file, num_artists, data_file)
+    if chunk and analysis_type in CHUNKED_TYPES:
+        if precision != "float64" or components:
+            logging.warning("Chunked runs keep full precision vectors")
+        runChunked(
+            analysis_type,
+            model_file,
+            artists_file,
+            num_artists,
+            data_file,
+            confirmOut(args.out),
+            chunk,
+            store_file,
+            engine
+        )
+    elif analysis_type == "corpora":
+        corpora = findCorpora(
+            model_file, artists_file, num_artists, data_file, store_file
+        )
         writeToOut(args.out, corpora)
     elif analysis_type == "vectors":
-        v = findVectors(model_file, artists_file, num_artists, data_file)
+        v = findVectors(
+            model_file,
+            artists_file,
+            num_artists,
+            data_file,
+            store_file,
+            engine,
+            args.out if args.update else None
+        )
+        if precision != "float64" or components:
+            v = representVectors(
+                v,
+                precision,
+                components,
+                projectionFile(args.out) if args.out else None,
+                stageKey(
+                    "vectors",
+                    modelKey(data_file),
+                    modelKey(artists_file),
+                    modelKey(model_file),
+                    engine,
+                    getFilterSettings(),
+                    str(num_artists)
+                )
+            )
         writeToOut(args.out, v)
+    elif analysis_type == "export_model":
+        exportModel(model_file, args.out)
     elif analysis_type == "deviations":
-        vectors = []
-        with open(data_file, "r") as v:
-            vectors = json.load(v)
-        deviations = findDeviation(vectors)
+        deviations = findDeviation(
+            readTable(data_file), readPrevious(args.out, args.update)
+        )
         writeToOut(args.out, deviations)
     elif analysis_type == "overall_deviations":
-        vectors = []
-        with open(data_file, "r") as v:
-            vectors = json.load(v)
-        deviations = findOverallDeviation(vectors)
+        deviations = findOverallDeviation(
+            readTable(data_file), readPrevious(args.out, args.update)
+        )
         writeToOut(args.out, deviations)
     elif analysis_type == "avg_deviations":
-        deviations = []
-        with open(data_file, "r") as df:
-            deviations = json.load(df)
-        avg_deviations = averageDeviation(deviations)
+        avg_deviations = averageDeviation(readTable(data_file))
         writeToOut(args.out, avg_deviations)
+    elif analysis_type == "pipeline":
+        # Non-interactive, the output is a folder with one file per stage
+        runPipeline(
+            model_file,
+            artists_file,
+            num_artists,
+            data_file,
+            config_file,
+            cache_dir,
+            args.out,
+            store_file,
+            engine,
+            precision,
+            components
+        )
+    elif analysis_type == "mobility":
+        vectors = readTable(data_file)
+        if vectors.titles is None:
+            logging.error("Mobility needs a binary vectors table")
+            return
+        if args.centers and not isTable(args.centers):
+            logging.error("Window centers are written as a binary table")
+            return
+        mobility = findMobility(
+            vectors,
+            args.path if args.path else "./data",
+            int(args.window) if args.window else 52,
+            args.centers
+        )
+        writeToOut(args.out, mobility)
+    elif analysis_type == "similar":
+        similar = findSimilar(
+            data_file,
+            lambda: readTable(data_file),
+            args.index if args.index else
+            os.path.splitext(data_file)[0] + ".index",
+            args.query,
+            int(args.top) if args.top else 10,
+            args.approximate,
+            args.evaluate
+        )
+        writeToOut(args.out, similar)
+    elif analysis_type == "filter_agreement":
+        # Number of songs rather than artists
+        agreement = filterAgreement(
+            data_file, int(args.num) if args.num else 1000, args.lexicon_out
+        )
+        writeToOut(args.out, agreement)
+    elif analysis_type == "correlate":
+        with open(artists_file, "r") as af:
+            artists = json.load(af)
+        correlation = correlate(
+            artists,
+            readTable(data_file),
+            int(args.resamples) if args.resamples else 10000,
+            int(args.seed) if args.seed else 0
+        )
+        writeToOut(args.out, correlation)
+    elif analysis_type == "convert":
+        # Output format follows the extension of the output file
+        writeToOut(args.out, readTable(data_file))
     else:
         logging.error("Invalid analysis type: %s" % (analysis_type))
+    tracer.save()
 
 
 if __name__ == "__main__":
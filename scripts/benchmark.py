@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import numpy as np
+from gensim.models import Word2Vec
+import analyze
+from merge import stream_merge, incremental_merge
+from tables import Table, VECTORS
+
+# Benchmarks that tag lyrics with nltk, and need its data to be installed
+FILTER_BENCHMARKS = ["filter_song", "get_texts"]
+
+# Benchmarks run by default, in order
+BENCHMARKS = FILTER_BENCHMARKS + [
+    "load_model",
+    "geometric_centre",
+    "find_vectors",
+    "standard_deviation",
+    "find_deviation",
+    "average_deviation",
+    "stream_merge",
+    "incremental_merge",
+]
+
+# Letters synthetic words are made of
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def makeVocabulary(size, rnd):
+    '''
+    Random distinct lowercase words. "hello" is always included, since
+    getGeometricCentre uses it to size empty songs.
+    '''
+    words = {"hello"}
+    while len(words) < size:
+        words.add(
+            "".join(rnd.choice(LETTERS) for _ in range(rnd.randint(3, 9)))
+        )
+    return sorted(words)
+
+
+def makeLyrics(vocabulary, rnd, lines=16, words=8):
+    '''
+    Raw lyrics in the format of Genius, with section annotations and some
+    punctuation for the cleaning and filtering steps to remove
+    '''
+    text = []
+    for i in range(lines):
+        if i % 8 == 0:
+            text.append("[Verse %d]" % (i // 8 + 1))
+        text.append(
+            " ".join(rnd.choice(vocabulary) for _ in range(words)) +
+            rnd.choice(["", ",", " (yeah)", " -"])
+        )
+    return "\n".join(text)
+
+
+def makeCorpus(folder, num_artists, num_songs, vocabulary, rnd):
+    '''
+    Writes a synthetic dataset to folder: an artists file, a merged data
+    file, a folder of Genius artist dumps for merge.py and the filtered
+    corpora the vectors stage works on. Returns their paths.
+    '''
+    artists = ["artist %d" % (i) for i in range(num_artists)]
+    data = []
+    texts = []
+    lyrics_folder = os.path.join(folder, "lyrics")
+    os.makedirs(lyrics_folder, exist_ok=True)
+    for (i, artist) in enumerate(artists):
+        songs = [
+            {
+                "title": "song %d %d" % (i, j),
+                "lyrics": makeLyrics(vocabulary, rnd)
+            } for j in range(num_songs)
+        ]
+        with open(
+            os.path.join(lyrics_folder, "artist%d.json" % (i)), "w"
+        ) as lf:
+            json.dump({"name": artist, "songs": songs}, lf)
+        data.extend(
+            {
+                "artist": artist,
+                "title": song["title"],
+                "lyrics": song["lyrics"],
+                "billboard": 1
+            } for song in songs
+        )
+        texts.append({
+            "artist": artist,
+            "songs": [
+                {
+                    "title": song["title"],
+                    "lyrics": " ".join(
+                        rnd.choice(vocabulary) for _ in range(64)
+                    )
+                } for song in songs
+            ]
+        })
+    files = {
+        "artists": os.path.join(folder, "artists.json"),
+        "data": os.path.join(folder, "data.json"),
+        "corpora": os.path.join(folder, "corpora.json"),
+        "lyrics": lyrics_folder
+    }
+    with open(files["artists"], "w") as af:
+        json.dump([{"name": a, "appearances": 1} for a in artists], af)
+    with open(files["data"], "w") as df:
+        json.dump(data, df)
+    with open(files["corpora"], "w") as cf:
+        json.dump(texts, cf)
+    return files
+
+
+def makeModel(folder, vocabulary, dimension, seed):
+    '''
+    Saves a Word2Vec model over vocabulary whose vectors are left randomly
+    initialized, both in full and exported as keyed vectors
+    '''
+    try:
+        model = Word2Vec(
+            vector_size=dimension, min_count=1, seed=seed, workers=1
+        )
+    except TypeError:
+        # gensim 3 names the dimension size
+        model = Word2Vec(size=dimension, min_count=1, seed=seed, workers=1)
+    model.build_vocab([[word] for word in vocabulary])
+    model_file = os.path.join(folder, "toy.model")
+    model.save(model_file)
+    kv_file = os.path.join(folder, "toy" + analyze.KEYED_VECTORS_SUFFIX)
+    analyze.exportModel(model_file, kv_file)
+    return (model_file, kv_file)
+
+
+def makeVectors(num_artists, num_songs, dimension, rnd):
+    '''
+    Random song vectors and centers in the layout of the vectors stage
+    '''
+    state = np.random.RandomState(rnd.randrange(1 << 31))
+    rows = [
+        state.randn(num_songs, dimension).astype(np.float32)
+        for _ in range(num_artists)
+    ]
+    return Table.fromRows(
+        VECTORS,
+        ["artist %d" % (i) for i in range(num_artists)],
+        rows,
+        centers=[np.mean(r, axis=0) for r in rows]
+    )
+
+
+def timeRuns(run, repeat, items, setup=None):
+    '''
+    Times repeat calls of run, after setup if given, and returns the
+    timings in seconds along with the throughput of the fastest one
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {
+        "items": items,
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "items_per_second": items / min(times) if min(times) > 0 else None,
+    }
+
+
+def runBenchmarks(names, params, folder, repeat):
+    '''
+    Generates the synthetic corpus and model in folder and runs the named
+    benchmarks on them
+    '''
+    rnd = random.Random(params["seed"])
+    vocabulary = makeVocabulary(params["vocabulary"], rnd)
+    files = makeCorpus(
+        folder, params["artists"], params["songs"], vocabulary, rnd
+    )
+    num_songs = params["artists"] * params["songs"]
+    with open(files["data"], "r") as df:
+        raw = [song["lyrics"] for song in json.load(df)]
+    with open(files["corpora"], "r") as cf:
+        texts = json.load(cf)
+    (model_file, kv_file) = (None, None)
+    if any(n in names for n in
+           ["load_model", "geometric_centre", "find_vectors"]):
+        (model_file, kv_file) = makeModel(
+            folder, vocabulary, params["dimension"], params["seed"]
+        )
+    vectors = makeVectors(
+        params["artists"], params["songs"], params["dimension"], rnd
+    )
+    deviations = analyze.findDeviation(vectors)
+    merged = os.path.join(folder, "merged.json")
+    cases = {
+        "filter_song": lambda: timeRuns(
+            lambda: [analyze.filterSong(lyrics) for lyrics in raw],
+            repeat,
+            num_songs
+        ),
+        "get_texts": lambda: timeRuns(
+            lambda: analyze.getTexts(
+                params["artists"], files["artists"], files["data"]
+            ),
+            repeat,
+            num_songs
+        ),
+        "load_model": lambda: {
+            "full": timeRuns(
+                lambda: analyze.loadModel(model_file), repeat, 1
+            ),
+            "keyed_vectors": timeRuns(
+                lambda: analyze.loadModel(kv_file), repeat, 1
+            ),
+        },
+        "geometric_centre": lambda: timeRuns(
+            lambda: [
+                analyze.getGeometricCentre(
+                    analyze.getModel(kv_file), song["lyrics"]
+                ) for text in texts for song in text["songs"]
+            ],
+            repeat,
+            num_songs
+        ),
+        "find_vectors": lambda: timeRuns(
+            lambda: analyze.findVectors(
+                kv_file,
+                files["artists"],
+                params["artists"],
+                files["corpora"]
+            ),
+            repeat,
+            num_songs
+        ),
+        "standard_deviation": lambda: timeRuns(
+            lambda: [
+                analyze.standardDeviation(
+                    vectors.centers[i], vectors.rows(i), 1
+                ) for i in range(len(vectors))
+            ],
+            repeat,
+            num_songs
+        ),
+        "find_deviation": lambda: timeRuns(
+            lambda: analyze.findDeviation(vectors), repeat, num_songs
+        ),
+        "average_deviation": lambda: timeRuns(
+            lambda: analyze.averageDeviation(deviations), repeat, num_songs
+        ),
+        "stream_merge": lambda: timeRuns(
+            lambda: stream_merge(files["lyrics"], merged + "l"),
+            repeat,
+            num_songs
+        ),
+        "incremental_merge": lambda: {
+            "cold": timeRuns(
+                lambda: incremental_merge(files["lyrics"], merged),
+                repeat,
+                num_songs,
+                setup=lambda: [
+                    os.remove(f) for f in [merged, merged + ".manifest.json"]
+                    if os.path.exists(f)
+                ]
+            ),
+            "unchanged": timeRuns(
+                lambda: incremental_merge(files["lyrics"], merged),
+                repeat,
+                num_songs
+            ),
+        },
+    }
+    results = {}
+    for name in names:
+        logging.info("Running %s" % (name))
+        results[name] = cases[name]()
+    return results
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(previous, results):
+    '''
+    Logs how the fastest time of each benchmark changed since a previous
+    results file
+    '''
+    def flatten(tree, prefix=""):
+        if "min" in tree:
+            return {prefix: tree["min"]}
+        flat = {}
+        for (key, value) in tree.items():
+            flat.update(flatten(value, prefix + "/" + key if prefix else key))
+        return flat
+    before = flatten(previous["results"])
+    for (name, seconds) in flatten(results).items():
+        if name in before and before[name] > 0:
+            logging.info(
+                "%s: %.4fs -> %.4fs (%.2fx)" %
+                (name, before[name], seconds, seconds / before[name])
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the analysis and merge stages on synthetic data"
+    )
+    parser.add_argument("-a", "--artists", help="Number of artists")
+    parser.add_argument("-s", "--songs", help="Songs per artist")
+    parser.add_argument("-v", "--vocabulary", help="Vocabulary size")
+    parser.add_argument("-D", "--dimension", help="Vector dimension")
+    parser.add_argument("-r", "--repeat", help="Runs of each benchmark")
+    parser.add_argument("--seed", help="Random seed")
+    parser.add_argument(
+        "-b",
+        "--bench",
+        help="Comma separated benchmarks to run (default all): " +
+        ", ".join(BENCHMARKS)
+    )
+    parser.add_argument(
+        "--no-filter",
+        action="store_true",
+        help="Skip the benchmarks that need nltk data"
+    )
+    parser.add_argument("-w", "--work", help="Folder for the synthetic data")
+    parser.add_argument("-c", "--compare", help="Previous results file")
+    parser.add_argument("-o", "--output", help="Results file")
+    args = parser.parse_args()
+
+    params = {
+        "artists": int(args.artists) if args.artists else 20,
+        "songs": int(args.songs) if args.songs else 20,
+        "vocabulary": int(args.vocabulary) if args.vocabulary else 2000,
+        "dimension": int(args.dimension) if args.dimension else 50,
+        "seed": int(args.seed) if args.seed else 0,
+    }
+    repeat = int(args.repeat) if args.repeat else 3
+    names = args.bench.split(",") if args.bench else BENCHMARKS
+    if args.no_filter:
+        names = [n for n in names if n not in FILTER_BENCHMARKS]
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error("Unknown benchmarks: %s" % (", ".join(unknown)))
+    out = args.output if args.output else "benchmark.json"
+
+    if args.work:
+        os.makedirs(args.work, exist_ok=True)
+        results = runBenchmarks(names, params, args.work, repeat)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            results = runBenchmarks(names, params, folder, repeat)
+    if args.compare:
+        with open(args.compare, "r") as cf:
+            compareResults(json.load(cf), results)
+    with open(out, "w") as of:
+        json.dump(
+            {
+                "commit": gitCommit(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "cpus": os.cpu_count(),
+                "params": params,
+                "results": results,
+            },
+            of,
+            indent=2
+        )
+    logging.info("Results written to %s" % (out))
+
+
+if __name__ == "__main__":
+    main()
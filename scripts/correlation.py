@@ -0,0 +1,165 @@
+import logging
+import multiprocessing
+import numpy as np
+from joblib import Parallel, delayed
+from scipy import stats
+from tables import AVG_DEVIATIONS
+
+# Correlation coefficients worked out, by name
+METHODS = ["pearson", "spearman"]
+
+# Resamples drawn by each parallel job at a time
+RESAMPLE_BLOCK = 1000
+
+# Coverage of bootstrap confidence intervals
+CONFIDENCE = 0.95
+
+
+def joinArtists(artists, averages):
+    '''
+    Pairs the chart appearances of each artist with their average
+    deviation, matching names case insensitively. Returns the names, both
+    arrays and the names of the artists with no appearances.
+    '''
+    if averages.kind != AVG_DEVIATIONS or averages.matrix.shape[1] != 1:
+        raise ValueError("Correlations need an avg_deviations table")
+    appearances = {a["name"].lower(): a["appearances"] for a in artists}
+    deviations = {
+        name.lower(): float(averages.matrix[i, 0])
+        for (i, name) in enumerate(averages.names)
+    }
+    names = [a["name"] for a in artists if a["name"].lower() in deviations]
+    missing = [
+        name for name in averages.names if name.lower() not in appearances
+    ]
+    x = np.array([appearances[n.lower()] for n in names], dtype=np.float64)
+    y = np.array([deviations[n.lower()] for n in names], dtype=np.float64)
+    return (names, x, y, missing)
+
+
+def pearsonRows(x, y):
+    '''
+    Pearson correlation of each row of x with the same row of y
+    '''
+    x = x - np.mean(x, axis=-1, keepdims=True)
+    y = y - np.mean(y, axis=-1, keepdims=True)
+    scale = np.sqrt(np.sum(x * x, axis=-1) * np.sum(y * y, axis=-1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(scale > 0, np.sum(x * y, axis=-1) / scale, np.nan)
+
+
+def spearmanRows(x, y):
+    '''
+    Spearman correlation of each row of x with the same row of y, i.e. the
+    Pearson correlation of their ranks, ties getting their average rank
+    '''
+    return pearsonRows(
+        stats.rankdata(x, axis=-1), stats.rankdata(y, axis=-1)
+    )
+
+
+def correlationRows(method, x, y):
+    return pearsonRows(x, y) if method == "pearson" else spearmanRows(x, y)
+
+
+def resampleBlock(x, y, size, seed):
+    '''
+    Draws a block of permutations of y against x and of bootstrap samples of
+    the (x, y) pairs, returning the correlations of every resample by method
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    permutations = np.argsort(rng.random((size, n)), axis=1)
+    samples = rng.integers(0, n, size=(size, n))
+    # Permuting y leaves its ranks unchanged up to the order
+    ranks = (stats.rankdata(x), stats.rankdata(y))
+    return {
+        "permutation": {
+            "pearson": pearsonRows(x[None, :], y[permutations]),
+            "spearman": pearsonRows(ranks[0][None, :], ranks[1][permutations]),
+        },
+        "bootstrap": {
+            method: correlationRows(method, x[samples], y[samples])
+            for method in METHODS
+        },
+    }
+
+
+def resample(x, y, resamples, seed, n_jobs=None):
+    '''
+    Draws resamples permutations and bootstrap samples in blocks, each with
+    its own seed spawned from seed, so results do not depend on the number
+    of jobs
+    '''
+    sizes = [
+        min(RESAMPLE_BLOCK, resamples - start)
+        for start in range(0, resamples, RESAMPLE_BLOCK)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    blocks = Parallel(
+        n_jobs=n_jobs if n_jobs else multiprocessing.cpu_count()
+    )(
+        delayed(resampleBlock)(x, y, size, s)
+        for (size, s) in zip(sizes, seeds)
+    )
+    return {
+        kind: {
+            method: np.concatenate([b[kind][method] for b in blocks])
+            for method in METHODS
+        } for kind in ["permutation", "bootstrap"]
+    }
+
+
+def correlate(artists, averages, resamples=10000, seed=0):
+    '''
+    Correlates the chart appearances of artists with their average
+    deviation. Besides the usual p-values, a two-sided permutation test
+    gives the share of shuffled pairings at least as correlated, and the
+    bootstrap gives percentile confidence intervals.
+    '''
+    (names, x, y, missing) = joinArtists(artists, averages)
+    if missing:
+        logging.warning(
+            "%d artists have no chart appearances" % (len(missing))
+        )
+    if len(names) < 3:
+        raise ValueError("Correlations need at least 3 artists")
+    logging.info(
+        "Correlating %d artists over %d resamples" % (len(names), resamples)
+    )
+    tests = {"pearson": stats.pearsonr, "spearman": stats.spearmanr}
+    drawn = resample(x, y, resamples, seed) if resamples > 0 else None
+    out = {
+        "artists": len(names),
+        "missing": missing,
+        "resamples": resamples,
+        "seed": seed,
+        "confidence": CONFIDENCE,
+    }
+    for method in METHODS:
+        r = float(correlationRows(method, x, y))
+        result = {"r": r, "p": float(tests[method](x, y)[1])}
+        if drawn is not None:
+            permuted = drawn["permutation"][method]
+            result["permutation_p"] = float(
+                (1 + np.sum(np.abs(permuted) >= abs(r) - 1e-12)) /
+                (1 + len(permuted))
+            )
+            bootstrap = drawn["bootstrap"][method]
+            # Samples repeating a single artist have no correlation
+            bootstrap = bootstrap[~np.isnan(bootstrap)]
+            tail = 100 * (1 - CONFIDENCE) / 2
+            result["interval"] = np.percentile(
+                bootstrap, [tail, 100 - tail]
+            ).tolist()
+        out[method] = result
+        logging.info(
+            "%s: r = %.4f, p = %.4g%s" % (
+                method, r, result["p"],
+                ", permutation p = %.4g, %d%% interval [%.4f, %.4f]" % (
+                    result["permutation_p"], 100 * CONFIDENCE,
+                    result["interval"][0], result["interval"][1]
+                ) if drawn is not None else ""
+            )
+        )
+    return out
@@ -0,0 +1,176 @@
+import json
+import os
+import re
+import zlib
+import numpy as np
+
+# Default share of shingles two songs of an artist must have in common for
+# one of them to be dropped as a near-duplicate (e.g. a remix or a live
+# version)
+THRESHOLD = 0.8
+
+# Words per shingle
+SHINGLE_SIZE = 3
+
+# Hash functions in each MinHash signature
+NUM_PERM = 128
+
+# Prime modulus of the hash functions, above every 32 bit shingle hash
+PRIME = np.uint64(4294967311)
+
+WORDS = re.compile(r"[\w']+")
+
+
+# Returns the hashes of the word shingles of some lyrics
+def shingles(lyrics, size=SHINGLE_SIZE):
+    words = WORDS.findall(lyrics.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    grams = [
+        " ".join(words[i:i + size])
+        for i in range(max(1, len(words) - size + 1))
+    ]
+    return np.unique(np.array(
+        [zlib.crc32(g.encode("utf-8")) for g in grams], dtype=np.uint64
+    ))
+
+
+# Returns the coefficients of num_perm random hash functions (a * x + b) mod
+# PRIME. Products of a and a 32 bit hash fit in 64 bits.
+def hash_functions(num_perm=NUM_PERM, seed=0):
+    state = np.random.RandomState(seed)
+    a = state.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+    b = state.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+    return (a[:, None], b[:, None])
+
+
+def signature(hashes, functions):
+    (a, b) = functions
+    return np.min((a * hashes[None, :] % PRIME + b) % PRIME, axis=1)
+
+
+# Returns the number of bands and rows per band of the LSH index. Pairs
+# that agree on every row of at least one band are compared, which happens
+# with probability 1 - (1 - s^rows)^bands for a similarity s, so rows are
+# picked for that curve to rise just below the threshold.
+def lsh_bands(threshold, num_perm=NUM_PERM):
+    best = 1
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows == 0 and \
+                (rows / num_perm) ** (1 / rows) <= threshold:
+            best = rows
+    return (num_perm // best, best)
+
+
+def find_root(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+# Groups near-duplicate songs of a single artist. Returns, for each
+# duplicate, its index and the index of its canonical song, the first of
+# its group, with their estimated similarity.
+def artist_duplicates(lyrics, threshold, functions, bands):
+    signatures = {}
+    for (i, text) in enumerate(lyrics):
+        hashes = shingles(text)
+        # Songs without lyrics are never duplicates
+        if len(hashes) > 0:
+            signatures[i] = signature(hashes, functions)
+    (num_bands, rows) = bands
+    parents = {i: i for i in signatures}
+    for band in range(num_bands):
+        buckets = {}
+        for (i, s) in signatures.items():
+            key = s[band * rows:(band + 1) * rows].tobytes()
+            buckets.setdefault(key, []).append(i)
+        for bucket in buckets.values():
+            for (n, i) in enumerate(bucket):
+                for j in bucket[n + 1:]:
+                    (ri, rj) = (find_root(parents, i), find_root(parents, j))
+                    if ri != rj and np.mean(
+                        signatures[i] == signatures[j]
+                    ) >= threshold:
+                        parents[max(ri, rj)] = min(ri, rj)
+    duplicates = []
+    for i in signatures:
+        root = find_root(parents, i)
+        if root != i:
+            duplicates.append((
+                i, root, float(np.mean(signatures[i] == signatures[root]))
+            ))
+    return duplicates
+
+
+# Finds near-duplicate songs within each artist's songs, in time linear in
+# the number of songs apart from the pairs that share an LSH bucket.
+# Returns a record of every dropped song, including its lyrics so that
+# incremental merges can restore it.
+def find_duplicates(songs, threshold=THRESHOLD, num_perm=NUM_PERM, seed=0):
+    functions = hash_functions(num_perm, seed)
+    bands = lsh_bands(threshold, num_perm)
+    artists = {}
+    for (i, song) in enumerate(songs):
+        artists.setdefault(song["artist"].lower(), []).append(i)
+    duplicates = []
+    for indices in artists.values():
+        found = artist_duplicates(
+            [songs[i]["lyrics"] for i in indices], threshold, functions, bands
+        )
+        for (i, canonical, similarity) in found:
+            song = songs[indices[i]]
+            duplicates.append({
+                "index": indices[i],
+                "artist": song["artist"],
+                "title": song["title"],
+                "lyrics": song["lyrics"],
+                "canonical": songs[indices[canonical]]["title"],
+                "canonical_index": indices[canonical],
+                "similarity": similarity
+            })
+    return sorted(duplicates, key=lambda d: d["index"])
+
+
+def drop_duplicates(songs, duplicates):
+    dropped = {d["index"] for d in duplicates}
+    return [song for (i, song) in enumerate(songs) if i not in dropped]
+
+
+# Puts dropped songs back where they were before deduplication
+def restore_duplicates(songs, duplicates):
+    restored = list(songs)
+    for d in sorted(duplicates, key=lambda d: d["index"]):
+        restored.insert(d["index"], {
+            "artist": d["artist"],
+            "title": d["title"],
+            "lyrics": d["lyrics"]
+        })
+    return restored
+
+
+# Drops near-duplicate songs, returning the songs that are kept and the
+# record of the dropped ones
+def dedup_songs(songs, threshold=THRESHOLD):
+    duplicates = find_duplicates(songs, threshold)
+    print("%d of %d songs are near-duplicates" % (len(duplicates), len(songs)))
+    return (drop_duplicates(songs, duplicates), duplicates)
+
+
+def duplicates_file(out):
+    return out + ".duplicates.json"
+
+
+# Returns the record of the songs dropped from a merged output, or None if
+# it is missing
+def load_duplicates(out):
+    if not os.path.exists(duplicates_file(out)):
+        return None
+    with open(duplicates_file(out), "r") as df:
+        return json.load(df)["duplicates"]
+
+
+def save_duplicates(out, duplicates, threshold):
+    with open(duplicates_file(out), "w") as df:
+        json.dump({"threshold": threshold, "duplicates": duplicates}, df)
@@ -0,0 +1,442 @@
+import difflib
+import json
+import os
+import re
+import time
+import zlib
+import nltk
+from collections import Counter, OrderedDict
+from nltk.tag.perceptron import PerceptronTagger
+
+# Punctuation replaced with spaces before tokenizing
+PUNCTUATION = re.compile(r"\.|\-|\(|\)|\–|\!|\?|\,")
+
+# Part of speech tags of words that are dropped from the lyrics
+DISCARD_TAGS = frozenset([
+    "CC", "CD", "EX", "FW",
+    "IN", "LS", "MD", "PRP",
+    "PRP$", "TO", "UH", "SYM",
+    "WDT", "WP", "WP$", "WRB"
+])
+
+# Default number of entries kept by each LRU cache
+CACHE_SIZE = 100000
+
+# Tokens as nltk.word_tokenize splits them: quotes were turned into `` and ''
+# beforehand, and contractions are split before n't and before clitics
+# such as 's or 'll, but not before other apostrophes (e.g. y'all)
+TOKENS = re.compile(
+    r"``|''"
+    r"|(?i:gon|wan)(?=na\b)|(?i:got)(?=ta\b)|(?i:gim|lem)(?=me\b)"
+    r"|(?i:can)(?=not\b)"
+    r"|[^\W_]+(?=(?i:n't)\b)|(?i:n't)\b"
+    r"|(?<=[^\W_])'(?i:s|m|d|ll|re|ve)\b"
+    r"|[^\W_]+(?:'(?!(?i:s|m|d|ll|re|ve)\b)[^\W_]+)*"
+    r"|[^\w\s]"
+)
+
+# Double quotes that open a quotation, tokenized as ``
+OPEN_QUOTE = re.compile(r'(^|[\s(\[{<])"')
+
+# Numbers, tagged CD
+NUMBER = re.compile(r"^\d+$")
+
+# Share of a word's tags that must be discarded for a lexicon derived from
+# a tagged corpus to drop it
+LEXICON_THRESHOLD = 0.5
+
+
+def filterSettings(
+    discard_tags=DISCARD_TAGS,
+    pattern=PUNCTUATION,
+    lexicon=None
+):
+    '''
+    Returns a stable fingerprint of the filter configuration, so that
+    results produced with different settings are never mixed up. Filters
+    that tag lyrics have no lexicon.
+    '''
+    settings = pattern.pattern + "\0" + "\0".join(sorted(discard_tags))
+    if lexicon is not None:
+        settings += "\0lexicon\0" + "\0".join(sorted(lexicon))
+    return "%08x" % (zlib.crc32(settings.encode("utf-8")))
+
+
+class LRUCache:
+    '''
+    Bounded least recently used cache that counts hits and misses
+    '''
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class LyricsFilter:
+    '''
+    Filters out unwanted words from lyrics with a single tagger instance.
+
+    Songs are tagged one line at a time. The averaged perceptron tagger only
+    looks at the two previous tags and the two surrounding words on each
+    side, so a line tagged with that context is memoized and reused whenever
+    the same line shows up again in the same position (e.g. a chorus). The
+    output is identical to tagging the whole song at once.
+    '''
+
+    def __init__(
+        self,
+        discard_tags=DISCARD_TAGS,
+        pattern=PUNCTUATION,
+        cache_size=CACHE_SIZE,
+        tagger=None
+    ):
+        self.discard_tags = frozenset(discard_tags)
+        self.pattern = pattern
+        self.tagger = tagger if tagger is not None else PerceptronTagger()
+        self.tag_cache = LRUCache(cache_size)
+        self.songs = 0
+        self.tokens = 0
+        self.seconds = 0.0
+        self.tokenize_seconds = 0.0
+        self.tag_seconds = 0.0
+
+    def settings(self):
+        return filterSettings(self.discard_tags, self.pattern)
+
+    def segment(self, text, tokens):
+        '''
+        Splits tokens into the lines of text they were found on. Falls back
+        to a single segment when the tokens cannot be aligned to the text.
+        '''
+        segments = []
+        current = []
+        position = 0
+        for token in tokens:
+            needle = '"' if token in ("``", "''") else token
+            start = text.find(needle, position)
+            if start < 0:
+                return [tokens]
+            if current and "\n" in text[position:start]:
+                segments.append(current)
+                current = []
+            current.append(token)
+            position = start + len(needle)
+        if current:
+            segments.append(current)
+        return segments
+
+    def predict(self, features):
+        label = self.tagger.model.predict(features)
+        # Newer versions of nltk also return the confidence
+        return label[0] if isinstance(label, tuple) else label
+
+    def tagSegment(self, tokens, context, prev, prev2):
+        tags = []
+        for i, word in enumerate(tokens):
+            tag = self.tagger.tagdict.get(word)
+            if not tag:
+                tag = self.predict(
+                    self.tagger._get_features(i, word, context, prev, prev2)
+                )
+            tags.append(tag)
+            prev2 = prev
+            prev = tag
+        return tags
+
+    def tag(self, text, tokens):
+        '''
+        Returns the tags of the given tokens, as nltk.pos_tag would
+        '''
+        start = self.tagger.START
+        context = start + [
+            self.tagger.normalize(w) for w in tokens
+        ] + self.tagger.END
+        prev, prev2 = start
+        tags = []
+        offset = 0
+        for segment in self.segment(text, tokens):
+            end = offset + len(segment)
+            # Window of the padded context seen by this segment
+            window = tuple(context[offset:end + 4])
+            key = (tuple(segment), window[:2], window[-2:], prev, prev2)
+            segment_tags = self.tag_cache.get(key)
+            if segment_tags is None:
+                segment_tags = self.tagSegment(
+                    segment, list(window), prev, prev2
+                )
+                self.tag_cache.put(key, segment_tags)
+            tags.extend(segment_tags)
+            if len(tags) >= 2:
+                (prev2, prev) = tags[-2:]
+            else:
+                (prev2, prev) = (prev, tags[-1])
+            offset = end
+        return tags
+
+    def tagged(self, song):
+        '''
+        Returns the tokens of a song and their tags
+        '''
+        text = self.pattern.sub(" ", song)
+        tokens = nltk.word_tokenize(text)
+        return (tokens, self.tag(text, tokens))
+
+    def filter(self, song):
+        '''
+        Filters out unwanted words (e.g. anything that isn't English,
+        articles, etc.)
+        '''
+        begin = time.perf_counter()
+        text = self.pattern.sub(" ", song)
+        tokens = nltk.word_tokenize(text)
+        tagging = time.perf_counter()
+        tags = self.tag(text, tokens)
+        tagged = time.perf_counter()
+        out = " ".join(
+            w for (w, t) in zip(tokens, tags) if t not in self.discard_tags
+        )
+        self.songs += 1
+        self.tokens += len(tokens)
+        self.seconds += time.perf_counter() - begin
+        self.tokenize_seconds += tagging - begin
+        self.tag_seconds += tagged - tagging
+        return out
+
+    def filterBatch(self, songs):
+        return [self.filter(song) for song in songs]
+
+    def stats(self):
+        '''
+        Returns cache and throughput counters
+        '''
+        lookups = self.tag_cache.hits + self.tag_cache.misses
+        return {
+            "pid": os.getpid(),
+            "songs": self.songs,
+            "tokens": self.tokens,
+            "seconds": self.seconds,
+            "tokenize_seconds": self.tokenize_seconds,
+            "tag_seconds": self.tag_seconds,
+            "hits": self.tag_cache.hits,
+            "misses": self.tag_cache.misses,
+            "hit_rate": self.tag_cache.hits / lookups if lookups else 0.0,
+            "songs_per_second":
+                self.songs / self.seconds if self.seconds else 0.0,
+            "tokens_per_second":
+                self.tokens / self.seconds if self.seconds else 0.0,
+        }
+
+
+def taggerLexicon(discard_tags=DISCARD_TAGS, tagger=None):
+    '''
+    Words the tagger always gives a discarded tag, without looking at their
+    context
+    '''
+    tagger = tagger if tagger is not None else PerceptronTagger()
+    return frozenset(
+        word for (word, tag) in tagger.tagdict.items() if tag in discard_tags
+    )
+
+
+def countTags(tagged):
+    '''
+    Counts the tags of each lowercased word in (tokens, tags) pairs
+    '''
+    counts = {}
+    for (tokens, tags) in tagged:
+        for (word, tag) in zip(tokens, tags):
+            counts.setdefault(word.lower(), Counter())[tag] += 1
+    return counts
+
+
+def corpusLexicon(counts, discard_tags=DISCARD_TAGS):
+    '''
+    Words given a discarded tag most of the time in a tagged corpus
+    '''
+    return frozenset(
+        word for (word, tags) in counts.items()
+        if sum(tags[t] for t in discard_tags if t in tags) >
+        LEXICON_THRESHOLD * sum(tags.values())
+    )
+
+
+def readLexicon(lexicon_file):
+    with open(lexicon_file, "r") as lf:
+        return frozenset(json.load(lf))
+
+
+def writeLexicon(lexicon_file, lexicon):
+    with open(lexicon_file, "w") as lf:
+        json.dump(sorted(lexicon), lf)
+
+
+class LexiconFilter:
+    '''
+    Filters out the same kind of words as LyricsFilter without tagging:
+    lyrics are split into tokens by a single regular expression, and tokens
+    found in a lexicon of closed-class words (or numbers) are dropped. The
+    lexicon is derived once from the tagger or from a tagged corpus, so
+    words whose tag depends on their context can be filtered differently.
+    '''
+
+    def __init__(
+        self,
+        lexicon=None,
+        discard_tags=DISCARD_TAGS,
+        pattern=PUNCTUATION
+    ):
+        self.lexicon = frozenset(
+            lexicon if lexicon is not None else taggerLexicon(discard_tags)
+        )
+        self.discard_tags = frozenset(discard_tags)
+        self.pattern = pattern
+        self.songs = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def settings(self):
+        return filterSettings(self.discard_tags, self.pattern, self.lexicon)
+
+    def tokenize(self, song):
+        text = OPEN_QUOTE.sub(r"\1 `` ", self.pattern.sub(" ", song))
+        return TOKENS.findall(text.replace('"', " '' "))
+
+    def keep(self, token):
+        return token not in self.lexicon and \
+            token.lower() not in self.lexicon and not NUMBER.match(token)
+
+    def filter(self, song):
+        begin = time.perf_counter()
+        tokens = self.tokenize(song)
+        out = " ".join(t for t in tokens if self.keep(t))
+        self.songs += 1
+        self.tokens += len(tokens)
+        self.seconds += time.perf_counter() - begin
+        return out
+
+    def filterBatch(self, songs):
+        return [self.filter(song) for song in songs]
+
+    def stats(self):
+        '''
+        Returns throughput counters, in the format of LyricsFilter
+        '''
+        return {
+            "pid": os.getpid(),
+            "songs": self.songs,
+            "tokens": self.tokens,
+            "seconds": self.seconds,
+            "tokenize_seconds": self.seconds,
+            "tag_seconds": 0.0,
+            "hits": 0,
+            "misses": 0,
+            "hit_rate": 0.0,
+            "songs_per_second":
+                self.songs / self.seconds if self.seconds else 0.0,
+            "tokens_per_second":
+                self.tokens / self.seconds if self.seconds else 0.0,
+        }
+
+
+def compareFilters(tagged, songs, lexicon_filter, discard_tags=DISCARD_TAGS):
+    '''
+    Token level agreement of a lexicon filter with the tagger, given the
+    tokens and tags of each song. Tokens are aligned first, since the two
+    tokenizers can split a few words differently.
+    '''
+    report = Counter()
+    misses = Counter()
+    begin = time.perf_counter()
+    for ((tokens, tags), song) in zip(tagged, songs):
+        fast = lexicon_filter.tokenize(song)
+        kept = [t not in discard_tags for t in tags]
+        fast_kept = [lexicon_filter.keep(t) for t in fast]
+        report["songs"] += 1
+        report["tokens"] += len(tokens)
+        report["identical"] += [w for (w, k) in zip(tokens, kept) if k] == \
+            [w for (w, k) in zip(fast, fast_kept) if k]
+        matcher = difflib.SequenceMatcher(None, tokens, fast, autojunk=False)
+        for (i, j, size) in matcher.get_matching_blocks():
+            for n in range(size):
+                (a, b) = (kept[i + n], fast_kept[j + n])
+                report["aligned"] += 1
+                report["agreed"] += a == b
+                if a and not b:
+                    report["only_lexicon_dropped"] += 1
+                    misses[tokens[i + n].lower()] += 1
+                elif b and not a:
+                    report["only_tagger_dropped"] += 1
+                    misses[tokens[i + n].lower()] += 1
+    seconds = time.perf_counter() - begin
+    aligned = report["aligned"]
+    return {
+        "songs": report["songs"],
+        "tokens": report["tokens"],
+        "lexicon_size": len(lexicon_filter.lexicon),
+        "token_alignment": aligned / report["tokens"]
+        if report["tokens"] else 0.0,
+        "agreement": report["agreed"] / aligned if aligned else 0.0,
+        "only_tagger_dropped": report["only_tagger_dropped"],
+        "only_lexicon_dropped": report["only_lexicon_dropped"],
+        "identical_songs": report["identical"] / report["songs"]
+        if report["songs"] else 0.0,
+        "comparison_seconds": seconds,
+        "disagreements": misses.most_common(50),
+    }
+
+
+# Counters of a filter's stats that add up, the others are rates
+COUNTERS = [
+    "songs", "tokens", "seconds", "tokenize_seconds", "tag_seconds",
+    "hits", "misses"
+]
+
+
+def statsSince(before, after):
+    '''
+    Counters of a filter between two calls of stats, e.g. for the songs of a
+    single chunk, as a filter's counters cover its whole lifetime
+    '''
+    since = {"pid": after["pid"]}
+    for key in COUNTERS:
+        since[key] = after[key] - before[key]
+    return since
+
+
+def mergeStats(stats):
+    '''
+    Combines the counters of several filters, or of several chunks of songs
+    (e.g. one per parallel job)
+    '''
+    total = {key: 0 for key in COUNTERS}
+    for s in stats:
+        for key in total:
+            total[key] += s[key]
+    lookups = total["hits"] + total["misses"]
+    total["hit_rate"] = total["hits"] / lookups if lookups else 0.0
+    total["songs_per_second"] = \
+        total["songs"] / total["seconds"] if total["seconds"] else 0.0
+    total["tokens_per_second"] = \
+        total["tokens"] / total["seconds"] if total["seconds"] else 0.0
+    return total
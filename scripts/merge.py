@@ -2,16 +2,138 @@
 
 import json
 import os
-import re
 import argparse
+import multiprocessing
+from joblib import Parallel, delayed
+from merging import clean_lyrics, stream_songs, parse_artist, file_entry
+from merging import load_manifest, save_manifest, read_songs, write_songs
+from merging import split_blocks
+from dedup import THRESHOLD, dedup_songs, find_duplicates, load_duplicates
+from dedup import restore_duplicates, drop_duplicates, save_duplicates
+
+
+# Writes songs as JSON Lines as they are parsed, so that only one song is
+# ever held in memory. Dropping near-duplicates needs the songs of one
+# artist at a time.
+def stream_merge(path, out, threshold=None):
+    duplicates = []
+    offset = 0
+    with open(out, "w") as of:
+        for json_file in os.listdir(path=path):
+            print(os.path.join(path, json_file))
+            with open(os.path.join(path, json_file), "rb") as lf:
+                songs = (
+                    {
+                        "artist": artist,
+                        "title": title,
+                        "lyrics": clean_lyrics(lyrics)
+                    } for (artist, title, lyrics) in stream_songs(lf)
+                    if lyrics is not None
+                )
+                if threshold is not None:
+                    songs = list(songs)
+                    found = find_duplicates(songs, threshold)
+                    kept = drop_duplicates(songs, found)
+                    for d in found:
+                        d["index"] += offset
+                        d["canonical_index"] += offset
+                    offset += len(songs)
+                    duplicates.extend(found)
+                    songs = kept
+                for song in songs:
+                    of.write(json.dumps(song) + "\n")
+    if threshold is not None:
+        print("%d songs are near-duplicates" % (len(duplicates)))
+        save_duplicates(out, duplicates, threshold)
+
+
+# Parses only the artist files that changed since the last run, in a process
+# pool, and splices their songs into the existing output. Songs dropped as
+# near-duplicates by the last run are put back first, since the manifest
+# counts every parsed song.
+def incremental_merge(path, out, threshold=None):
+    manifest = load_manifest(out)
+    duplicates = []
+    if manifest is not None and manifest.get("dedup") is not None:
+        duplicates = load_duplicates(out)
+        if duplicates is None:
+            manifest = None
+    previous = {}
+    blocks = {}
+    if manifest is not None:
+        previous = {entry["name"]: entry for entry in manifest["files"]}
+        blocks = split_blocks(
+            restore_duplicates(read_songs(out), duplicates), manifest["files"]
+        )
+    entries = []
+    changed = []
+    for json_file in sorted(os.listdir(path=path)):
+        entry = file_entry(
+            os.path.join(path, json_file), previous.get(json_file)
+        )
+        entry["name"] = json_file
+        if json_file not in previous or \
+                previous[json_file]["sha1"] != entry["sha1"]:
+            changed.append(json_file)
+        entries.append(entry)
+    print("%d of %d files changed" % (len(changed), len(entries)))
+    parsed = Parallel(n_jobs=multiprocessing.cpu_count())(
+        delayed(parse_artist)(
+            os.path.join(path, json_file)
+        ) for json_file in changed
+    )
+    blocks.update(zip(changed, parsed))
+    data = []
+    for entry in entries:
+        entry["songs"] = len(blocks[entry["name"]])
+        data.extend(blocks[entry["name"]])
+    if threshold is not None:
+        (data, duplicates) = dedup_songs(data, threshold)
+        save_duplicates(out, duplicates, threshold)
+    write_songs(out, data)
+    save_manifest(out, {"files": entries, "dedup": threshold})
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--path", help="Lyrics folder path")
     parser.add_argument("-o", "--output", help="Output file")
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        help="Stream songs to a JSON Lines output file"
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only parse files that changed since the last run"
+    )
+    parser.add_argument(
+        "-D",
+        "--dedup",
+        action="store_true",
+        help="Drop near-duplicate songs of each artist"
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        help="Similarity of near-duplicate songs (default %.1f)" % (THRESHOLD)
+    )
     args = parser.parse_args()
     path = args.path if args.path else "."
+    threshold = None
+    if args.dedup:
+        threshold = float(args.threshold) if args.threshold else THRESHOLD
+    if args.incremental:
+        out = args.output if args.output else "lyrics.json"
+        incremental_merge(path, out, threshold)
+        return
+    if args.stream:
+        out = args.output if args.output else "lyrics.jsonl"
+        stream_merge(path, out, threshold)
+        return
     out = args.output if args.output else "lyrics.json"
     data = []
     for json_file in os.listdir(path=path):
@@ -22,22 +144,16 @@ def main():
             artist = raw["name"]
             for lyrics in songs:
                 if lyrics["lyrics"] is not None:
-                    lyrics["lyrics"] = re.sub(
-                        r"\[.*?\]",
-                        "",
-                        lyrics["lyrics"]
-                    )
-                    lyrics["lyrics"] = re.sub(
-                        r"[,\(\)-]",
-                        "",
-                        lyrics["lyrics"]
-                    )
+                    lyrics["lyrics"] = clean_lyrics(lyrics["lyrics"])
                     lyrics_new = {
                         "artist": artist,
                         "title": lyrics["title"],
                         "lyrics": lyrics["lyrics"]
                     }
                 data.append(lyrics_new)
+    if threshold is not None:
+        (data, duplicates) = dedup_songs(data, threshold)
+        save_duplicates(out, duplicates, threshold)
     with open(out, "w") as of:
         json.dump(data, of)
 
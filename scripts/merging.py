@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import re
+import ijson
+
+# Annotations such as [Chorus] or [Verse 1]
+BRACKETS = re.compile(r"\[.*?\]")
+PUNCTUATION = re.compile(r"[,\(\)-]")
+
+
+def clean_lyrics(lyrics):
+    return PUNCTUATION.sub("", BRACKETS.sub("", lyrics))
+
+
+# Yields the artist, title and lyrics of each song in a Genius artist dump,
+# parsing it incrementally and skipping everything else
+def stream_songs(lf):
+    artist = None
+    title = None
+    lyrics = None
+    for (prefix, event, value) in ijson.parse(lf):
+        if prefix == "name":
+            artist = value
+        elif prefix == "songs.item.title":
+            title = value
+        elif prefix == "songs.item.lyrics":
+            lyrics = value
+        elif prefix == "songs.item" and event == "end_map":
+            yield (artist, title, lyrics)
+            title = None
+            lyrics = None
+
+
+# Returns the cleaned songs of a Genius artist dump
+def parse_artist(json_file):
+    with open(json_file, "rb") as lf:
+        return [
+            {
+                "artist": artist,
+                "title": title,
+                "lyrics": clean_lyrics(lyrics)
+            } for (artist, title, lyrics) in stream_songs(lf)
+            if lyrics is not None
+        ]
+
+
+# Cleans a list of songs in the format of scrape.py
+def clean_songs(songs):
+    return [
+        {
+            "artist": song["artist"],
+            "title": song["title"],
+            "lyrics": clean_lyrics(song["lyrics"])
+        } for song in songs if song["lyrics"] is not None
+    ]
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+# Returns the size, mtime and hash of a file, only hashing it again if its
+# size or mtime differ from the previous manifest entry
+def file_entry(path, previous=None):
+    entry = file_stat(path)
+    if previous is not None and previous["size"] == entry["size"] and \
+            previous["mtime"] == entry["mtime"]:
+        entry["sha1"] = previous["sha1"]
+    else:
+        entry["sha1"] = file_hash(path)
+    return entry
+
+
+def manifest_file(out):
+    return out + ".manifest.json"
+
+
+# Returns the manifest of a merged output file, or None if either the
+# manifest or the output are missing
+def load_manifest(out):
+    if not os.path.exists(out) or not os.path.exists(manifest_file(out)):
+        return None
+    with open(manifest_file(out), "r") as mf:
+        return json.load(mf)
+
+
+def save_manifest(out, manifest):
+    with open(manifest_file(out), "w") as mf:
+        json.dump(manifest, mf)
+
+
+# Reads merged songs, either a JSON list or JSON Lines
+def read_songs(path):
+    with open(path, "r") as df:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in df if line.strip()]
+        return json.load(df)
+
+
+def write_songs(path, songs):
+    with open(path, "w") as of:
+        if path.endswith(".jsonl"):
+            for song in songs:
+                of.write(json.dumps(song) + "\n")
+        else:
+            json.dump(songs, of)
+
+
+# Splits merged songs back into the blocks listed in a manifest
+def split_blocks(songs, entries):
+    blocks = {}
+    offset = 0
+    for entry in entries:
+        blocks[entry["name"]] = songs[offset:offset + entry["songs"]]
+        offset += entry["songs"]
+    return blocks
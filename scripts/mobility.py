@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import numpy as np
+from registry import song_key
+from tables import Table, TableWriter, VECTORS
+from top_artists import WEEK_FILE
+
+
+def readWeeks(path):
+    '''
+    Returns the date and songs of every weekly chart file in path, in order
+    '''
+    weeks = []
+    for week_file in sorted(os.listdir(path)):
+        match = WEEK_FILE.match(week_file)
+        if match is None:
+            continue
+        with open(os.path.join(path, week_file), "r") as wf:
+            weeks.append((match.group(1), json.load(wf)))
+    return weeks
+
+
+def songIndex(vectors):
+    '''
+    Maps the normalized artist and title of every song in a vectors table to
+    its row
+    '''
+    index = {}
+    for i in range(len(vectors)):
+        for (j, title) in enumerate(vectors.titles[i]):
+            index[song_key(title, vectors.names[i])] = (
+                vectors.names[i], vectors.offsets[i] + j
+            )
+    return index
+
+
+class Accumulator:
+    '''
+    Running count, vector sum and sum of squared norms of a set of song
+    vectors, from which their center and deviation are worked out
+    '''
+
+    def __init__(self, size):
+        self.count = 0
+        self.sums = np.zeros(size)
+        self.squares = 0.0
+
+    def add(self, vector):
+        self.count += 1
+        self.sums += vector
+        self.squares += np.dot(vector, vector)
+
+    def remove(self, vector):
+        self.count -= 1
+        self.sums -= vector
+        self.squares -= np.dot(vector, vector)
+
+    def center(self):
+        return self.sums / self.count
+
+    def deviation(self, center=None):
+        '''
+        Root mean square Euclidean distance of the vectors from center
+        (their own center by default)
+        '''
+        if center is None:
+            center = self.center()
+        squares = self.squares - 2 * np.dot(center, self.sums) + \
+            self.count * np.dot(center, center)
+        return float(np.sqrt(max(squares / self.count, 0.0)))
+
+
+class WindowStats:
+    '''
+    Centers and deviations of each artist and of the whole chart over a
+    window of weeks. Weeks are added and removed as the window slides, and
+    only the artists whose songs entered or left the window are updated.
+    A song is counted once however many weeks of the window it charted in.
+    '''
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.weeks = {}
+        self.charting = {}
+        self.artists = {}
+        self.centers = {}
+        self.center_sum = np.zeros(matrix.shape[1])
+        self.chart = Accumulator(matrix.shape[1])
+
+    def vector(self, row):
+        return np.asarray(self.matrix[row], dtype=np.float64)
+
+    def touch(self, name, update):
+        artist = self.artists.get(name)
+        if artist is None:
+            artist = self.artists[name] = Accumulator(self.matrix.shape[1])
+        if name in self.centers:
+            self.center_sum -= self.centers.pop(name)
+        update(artist)
+        if artist.count > 0:
+            self.centers[name] = artist.center()
+            self.center_sum += self.centers[name]
+        else:
+            # Starting over keeps rounding errors from building up
+            del self.artists[name]
+
+    def addWeek(self, week, songs):
+        self.weeks[week] = songs
+        for (name, row) in songs:
+            self.charting[row] = self.charting.get(row, 0) + 1
+            if self.charting[row] > 1:
+                continue
+            vector = self.vector(row)
+            self.chart.add(vector)
+            self.touch(name, lambda artist: artist.add(vector))
+
+    def removeWeek(self, week):
+        for (name, row) in self.weeks.pop(week):
+            self.charting[row] -= 1
+            if self.charting[row] > 0:
+                continue
+            del self.charting[row]
+            vector = self.vector(row)
+            self.chart.remove(vector)
+            self.touch(name, lambda artist: artist.remove(vector))
+
+    def snapshot(self):
+        '''
+        Song counts and deviations of the artists in the window, and of the
+        chart around the mean of their centers
+        '''
+        if len(self.centers) == 0:
+            return {"songs": 0, "artists": []}
+        center = self.center_sum / len(self.centers)
+        return {
+            "songs": self.chart.count,
+            "deviation": self.chart.deviation(center),
+            "artists": [
+                {
+                    "name": name,
+                    "songs": self.artists[name].count,
+                    "deviation": self.artists[name].deviation()
+                } for name in sorted(self.centers)
+            ]
+        }
+
+    def snapshotCenters(self):
+        '''
+        Names and centers of the artists in the window, and the center of
+        the chart
+        '''
+        names = sorted(self.centers)
+        return (
+            names,
+            [self.centers[name] for name in names],
+            self.center_sum / len(self.centers)
+        )
+
+
+def windowCenters(name, stats):
+    '''
+    Returns the centers of a window as a one entry table named like
+    "rolling/<week>" or "years/<year>": its rows are the centers of the
+    window's artists, titled with their names, and its center is the
+    chart's
+    '''
+    (artists, centers, chart) = stats.snapshotCenters()
+    return Table(
+        VECTORS,
+        [name],
+        [0, len(centers)],
+        np.array(centers, dtype=np.float64),
+        chart[None, :],
+        [artists]
+    )
+
+
+def matchWeeks(vectors, weeks):
+    '''
+    Returns the artist and row of every chart entry of each week that has a
+    vector
+    '''
+    index = songIndex(vectors)
+    matched = []
+    (found, missing) = (0, 0)
+    for (week, songs) in weeks:
+        rows = []
+        for song in songs:
+            key = song_key(song["title"], song["artist"])
+            if key in index:
+                rows.append(index[key])
+            else:
+                missing += 1
+        found += len(rows)
+        matched.append((week, rows))
+    logging.info(
+        "%d chart entries matched, %d without vectors" % (found, missing)
+    )
+    return matched
+
+
+def slideWindows(matrix, weeks, window):
+    '''
+    Yields the kind ("rolling" or "years"), key and stats of every window:
+    a rolling window of weeks ending at each week, and each year of weeks
+    '''
+    rolling = WindowStats(matrix)
+    year = None
+    for (week, rows) in weeks:
+        rolling.addWeek(week, rows)
+        if len(rolling.weeks) > window:
+            # Weeks are kept in the order they were added
+            rolling.removeWeek(next(iter(rolling.weeks)))
+        yield ("rolling", week, rolling)
+        if year is None or year != week[:4]:
+            if year is not None:
+                yield ("years", year, yearly)
+            (year, yearly) = (week[:4], WindowStats(matrix))
+        yearly.addWeek(week, rows)
+    if year is not None:
+        yield ("years", year, yearly)
+
+
+def findMobility(vectors, path, window, centers_file=None):
+    '''
+    Works out deviations over a rolling window of weeks, ending at each week
+    of the charts in path, and over each year of charts. The centers of
+    every window take far more space than the rest, so they are only saved,
+    as a binary table, when centers_file is given. They are then written
+    one window at a time, sliding the windows again once the size of the
+    table is known.
+    '''
+    logging.info("Running mobility analysis")
+    weeks = matchWeeks(vectors, readWeeks(path))
+    out = {"window": window, "rolling": {}, "years": {}}
+    counts = []
+    for (kind, key, stats) in slideWindows(vectors.matrix, weeks, window):
+        out[kind][key] = stats.snapshot()
+        if len(stats.centers) > 0:
+            counts.append(len(stats.centers))
+    if centers_file:
+        writer = TableWriter(
+            centers_file,
+            VECTORS,
+            len(counts),
+            sum(counts),
+            vectors.matrix.shape[1]
+        )
+        for (kind, key, stats) in slideWindows(
+            vectors.matrix, weeks, window
+        ):
+            # Windows without artists are left out
+            if len(stats.centers) > 0:
+                writer.append(windowCenters(kind + "/" + key, stats))
+        writer.close()
+        out["centers_file"] = centers_file
+        logging.info("Window centers written to %s" % (centers_file))
+    return out
@@ -1,41 +1,104 @@
 #!/usr/bin/python3
 
 import json
-import os
-import re
+import hashlib
 import argparse
+import multiprocessing
+from joblib import Parallel, delayed
+from merging import clean_songs, file_entry, load_manifest, save_manifest
+from merging import read_songs, write_songs, split_blocks
+from dedup import THRESHOLD, dedup_songs, load_duplicates, restore_duplicates
+from dedup import save_duplicates
+
+# Number of input songs cleaned by each parallel job
+CHUNK_SIZE = 1000
+
+
+# Hash of the fields of a chunk of songs that end up in the output
+def chunk_hash(songs):
+    return hashlib.sha1(json.dumps([
+        [song["artist"], song["title"], song["lyrics"]] for song in songs
+    ]).encode("utf-8")).hexdigest()
+
+
+# Cleans songs in chunks in a process pool. With a manifest from a previous
+# run, only the chunks whose songs changed are cleaned again. Songs dropped
+# as near-duplicates by the last run are put back first, since the manifest
+# counts every cleaned song.
+def merge(data_file, out, incremental, threshold=None):
+    manifest = load_manifest(out) if incremental else None
+    duplicates = []
+    if manifest is not None and manifest.get("dedup") is not None:
+        duplicates = load_duplicates(out)
+        if duplicates is None:
+            manifest = None
+    previous = manifest["input"] if manifest is not None else None
+    entry = file_entry(data_file, previous)
+    if previous is not None and previous["sha1"] == entry["sha1"] and \
+            manifest.get("dedup") == threshold:
+        print("%s has not changed" % (data_file))
+        return
+    with open(data_file, "r") as lf:
+        raw = json.load(lf)
+    chunks = [
+        raw[i:i + CHUNK_SIZE] for i in range(0, len(raw), CHUNK_SIZE)
+    ]
+    entries = [{"name": chunk_hash(chunk)} for chunk in chunks]
+    blocks = {}
+    if manifest is not None:
+        blocks = split_blocks(
+            restore_duplicates(read_songs(out), duplicates),
+            manifest["chunks"]
+        )
+    changed = [
+        i for i in range(len(chunks)) if entries[i]["name"] not in blocks
+    ]
+    print("%d of %d chunks changed" % (len(changed), len(chunks)))
+    cleaned = Parallel(n_jobs=multiprocessing.cpu_count())(
+        delayed(clean_songs)(chunks[i]) for i in changed
+    )
+    blocks.update(zip((entries[i]["name"] for i in changed), cleaned))
+    data = []
+    for e in entries:
+        e["songs"] = len(blocks[e["name"]])
+        data.extend(blocks[e["name"]])
+    if threshold is not None:
+        (data, duplicates) = dedup_songs(data, threshold)
+        save_duplicates(out, duplicates, threshold)
+    write_songs(out, data)
+    save_manifest(
+        out, {"input": entry, "chunks": entries, "dedup": threshold}
+    )
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--d", help="Data file")
+    parser.add_argument("-d", "--data", help="Data file")
     parser.add_argument("-o", "--output", help="Output file")
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only clean songs that changed since the last run"
+    )
+    parser.add_argument(
+        "-D",
+        "--dedup",
+        action="store_true",
+        help="Drop near-duplicate songs of each artist"
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        help="Similarity of near-duplicate songs (default %.1f)" % (THRESHOLD)
+    )
     args = parser.parse_args()
     data = args.data if args.data else "data/data.json"
     out = args.output if args.output else "raw_lyrics.json"
-    data = []
-    with open(path, "r") as lf:
-        raw = json.load(lf)
-        for lyrics in raw:
-            if lyrics["lyrics"] is not None:
-                lyrics["lyrics"] = re.sub(
-                    r"\[.*?\]",
-                    "",
-                    lyrics["lyrics"]
-                )
-                lyrics["lyrics"] = re.sub(
-                    r"[,\(\)-]",
-                    "",
-                    lyrics["lyrics"]
-                )
-                lyrics_new = {
-                    "artist": lyrics["artist"],
-                    "title": lyrics["title"],
-                    "lyrics": lyrics["lyrics"]
-                }
-            data.append(lyrics_new)
-    with open(out, "w") as of:
-        json.dump(data, of)
+    threshold = None
+    if args.dedup:
+        threshold = float(args.threshold) if args.threshold else THRESHOLD
+    merge(data, out, args.incremental, threshold)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import sqlite3
+
+
+# Key used to match songs regardless of case and spacing
+def song_key(title, artist):
+    return (" ".join(artist.lower().split()), " ".join(title.lower().split()))
+
+
+# Songs collected so far, indexed by normalized artist and title
+class SongRegistry:
+    def __init__(self):
+        self.data = []
+        self.index = {}
+
+    def get(self, title, artist):
+        return self.index.get(song_key(title, artist))
+
+    def add(self, song):
+        self.index[song_key(song["title"], song["artist"])] = song
+        self.data.append(song)
+
+    def __len__(self):
+        return len(self.data)
+
+
+# On-disk cache of Genius lookups, including the ones that found nothing
+class LyricsCache:
+    def __init__(self, cache_file):
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS lyrics (
+                artist TEXT NOT NULL,
+                title TEXT NOT NULL,
+                lyrics TEXT NOT NULL,
+                found INTEGER NOT NULL,
+                PRIMARY KEY (artist, title)
+            )
+            '''
+        )
+
+    # Returns the cached lyrics of a song ("" for a known miss), or None if
+    # the song was never looked up
+    def get(self, title, artist):
+        row = self.connection.execute(
+            "SELECT lyrics FROM lyrics WHERE artist = ? AND title = ?",
+            song_key(title, artist)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, title, artist, lyrics):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?, ?)",
+                song_key(title, artist) + (lyrics, 1 if lyrics else 0)
+            )
+
+    def close(self):
+        self.connection.close()
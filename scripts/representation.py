@@ -0,0 +1,159 @@
+import logging
+import os
+import numpy as np
+from scipy import stats
+from sklearn.decomposition import PCA
+from tables import Table, TABLE_SUFFIX, VECTORS
+
+# Storage types of song vectors and centers
+PRECISIONS = {
+    "float64": np.float64,
+    "float32": np.float32,
+    "float16": np.float16,
+}
+
+# Number of song vectors projected at a time
+PROJECTION_BLOCK = 8192
+
+
+def projectionFile(path):
+    '''
+    Returns the path of the PCA projection saved with a vectors table
+    '''
+    base = path[:-len(TABLE_SUFFIX)] if path.endswith(TABLE_SUFFIX) else \
+        os.path.splitext(path)[0]
+    return base + ".pca.npz"
+
+
+def fitProjection(matrix, components, seed=0):
+    '''
+    Fits a PCA projection of song vectors to the given number of components
+    '''
+    logging.info("Fitting a PCA projection to %d components" % (components))
+    pca = PCA(n_components=components, random_state=seed)
+    pca.fit(np.asarray(matrix, dtype=np.float64))
+    logging.info(
+        "Explained variance: %.1f%%" %
+        (100 * np.sum(pca.explained_variance_ratio_))
+    )
+    return {
+        "mean": pca.mean_,
+        "components": pca.components_,
+        "explained_variance_ratio": pca.explained_variance_ratio_,
+    }
+
+
+def loadProjection(path, components, dimension, key=None):
+    '''
+    Returns the projection saved at path if it has the given number of
+    components for vectors of the given dimension and, when key is given,
+    was fitted on the vectors it identifies. None otherwise.
+    '''
+    if path is None or not os.path.exists(path):
+        return None
+    with np.load(path) as pf:
+        projection = {name: pf[name] for name in pf.files}
+    if projection["components"].shape != (components, dimension):
+        return None
+    if key is not None and str(projection.get("key")) != key:
+        logging.info(
+            "The PCA projection in %s was fitted on other vectors" % (path)
+        )
+        return None
+    logging.info("Reusing the PCA projection in %s" % (path))
+    return projection
+
+
+def getProjection(matrix, components, path=None, key=None):
+    '''
+    Returns the projection of a dataset, fitting it only the first time and
+    saving it to path for the later stages and runs. key identifies the
+    vectors, so that a projection is only reused for the same ones.
+    '''
+    if components > min(matrix.shape):
+        logging.warning(
+            "Only %d PCA components can be fitted" % (min(matrix.shape))
+        )
+        components = min(matrix.shape)
+    projection = loadProjection(path, components, matrix.shape[1], key)
+    if projection is None:
+        projection = fitProjection(matrix, components)
+        if key is not None:
+            projection["key"] = np.array(key)
+        if path is not None:
+            np.savez(path, **projection)
+    return projection
+
+
+def project(matrix, projection, dtype):
+    out = np.empty(
+        (len(matrix), len(projection["components"])), dtype=dtype
+    )
+    for start in range(0, len(matrix), PROJECTION_BLOCK):
+        block = np.asarray(
+            matrix[start:start + PROJECTION_BLOCK], dtype=np.float64
+        )
+        out[start:start + len(block)] = \
+            (block - projection["mean"]) @ projection["components"].T
+    return out
+
+
+def representVectors(
+    vectors,
+    precision="float64",
+    components=None,
+    projection_file=None,
+    key=None
+):
+    '''
+    Returns a vectors table stored with the given precision, projected to
+    the given number of PCA components first if any. Centers are projected
+    like songs, as the projection keeps means. key identifies the vectors
+    the projection saved to projection_file is fitted on.
+    '''
+    dtype = PRECISIONS[precision]
+    if components:
+        projection = getProjection(
+            vectors.matrix, components, projection_file, key
+        )
+        matrix = project(vectors.matrix, projection, dtype)
+        centers = project(vectors.centers, projection, dtype)
+    else:
+        matrix = np.asarray(vectors.matrix, dtype=dtype)
+        centers = np.asarray(vectors.centers, dtype=dtype)
+    logging.info(
+        "Vectors stored as %d x %d %s (%.1f MB, from %.1f MB)" % (
+            matrix.shape[0], matrix.shape[1], precision,
+            matrix.nbytes / 1e6, vectors.matrix.nbytes / 1e6
+        )
+    )
+    return Table(
+        VECTORS,
+        vectors.names,
+        vectors.offsets,
+        matrix,
+        centers,
+        vectors.titles
+    )
+
+
+def compareOutputs(full, reduced):
+    '''
+    How much the rows of a deviations table changed with a reduced vector
+    representation: absolute and relative differences, and the rank
+    correlation of the two, which is what comparisons between artists
+    depend on
+    '''
+    full = np.asarray(full.matrix, dtype=np.float64).ravel()
+    reduced = np.asarray(reduced.matrix, dtype=np.float64).ravel()
+    difference = np.abs(full - reduced)
+    scale = np.abs(full)
+    scale[scale == 0] = 1
+    return {
+        "max_abs": float(np.max(difference)) if len(difference) else 0.0,
+        "mean_abs": float(np.mean(difference)) if len(difference) else 0.0,
+        "max_rel": float(np.max(difference / scale))
+        if len(difference) else 0.0,
+        "rank_correlation": float(stats.spearmanr(full, reduced)[0])
+        if len(difference) > 1 else 1.0,
+    }
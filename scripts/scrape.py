@@ -7,114 +7,193 @@ import re
 import sys
 import json
 import urllib.request
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import time
 import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import as_completed
+from registry import SongRegistry, LyricsCache, song_key
 
 BILLBOARD = "https://www.billboard.com/charts/hot-100"
 
+# Divs holding the title and artist of each chart item
+CHART_ITEMS = SoupStrainer(
+    "div", class_=["item-details__title", "item-details__artist"]
+)
+OPEN_DIV = re.compile("<div .*?>")
+CLOSE_DIV = re.compile("</div>")
+AMPERSAND = re.compile("&amp;")
 
-# Downloads Billboard top 100 list for given week, extracts relevant data
-def get_top_songs(date):
-    date_string = str(date).split()[0]
-    print("Fetching top 100 data for the week of %s..." % (date_string))
-    url = BILLBOARD + "/" + date_string
-    while True:
-        try:
-            # Download Top 100 page
+# Weeks fetched by each thread per batch of scrape_concurrent. Weeks are
+# written at the end of each batch, so a crash loses at most one batch.
+WEEKS_PER_JOB = 4
+
+
+# Spaces out requests so that no more than rate are started per second,
+# across all threads
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+# Makes rate limited calls, retrying failures with exponential backoff and
+# full jitter up to a maximum number of retries
+class Fetcher:
+    def __init__(self, rate=5.0, retries=5, backoff=1.0, max_backoff=60.0):
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def call(self, function, *args):
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            try:
+                return function(*args)
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                delay = random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt)
+                )
+                print("%s, trying again in %.1fs..." % (e, delay))
+                time.sleep(delay)
+                attempt += 1
+
+    def get(self, url):
+        def download():
             req = urllib.request.Request(
                 url,
                 headers={'User-Agent': "Magic Browser"}
             )
-            break
-        except Exception as e:
-            print("%s, trying again..." % (e))
-            time.sleep(1)
-    soup = BeautifulSoup(urllib.request.urlopen(req).read(), "html.parser")
-    # Extract songs from divs
-    songs = soup.find_all(
-        lambda tag: tag.name == 'div' and
-        tag.get('class') == ['item-details__title']
-    )
-    # Extract artists from divs
-    artists = soup.find_all(
-        lambda tag: tag.name == 'div' and
-        tag.get('class') == ['item-details__artist']
-    )
+            with urllib.request.urlopen(req) as response:
+                return response.read()
+        return self.call(download)
+
+
+# Extracts the title and artist of each song in a Billboard top 100 page,
+# only building the chart item divs
+def parse_top_songs(html):
+    soup = BeautifulSoup(html, "html.parser", parse_only=CHART_ITEMS)
     s = []
     a = []
-    # Parse songs into something usable
-    for song in songs:
-        s.append(
-            re.sub(
-                "&amp;",
-                "&",
-                re.sub(
-                    "</div>",
-                    "",
-                    re.sub(
-                        "<div .*?>",
-                        "",
-                        str(song)
-                    )
-                )
-            )
-        )
-    # Parse artists into something usable
-    for artist in artists:
-        a.append(
-            re.sub(
-                "&amp;",
-                "&",
-                re.sub(
-                    "</div>",
-                    "",
-                    re.sub(
-                        "<div .*?>",
-                        "",
-                        str(artist)
-                    )
-                )
-            )
+    for tag in soup.find_all("div"):
+        classes = tag.get("class")
+        if classes == ["item-details__title"]:
+            s.append(clean_item(tag))
+        elif classes == ["item-details__artist"]:
+            a.append(clean_item(tag))
+    return list(zip(s, a))
+
+
+# Text of a chart item div
+def clean_item(tag):
+    return AMPERSAND.sub("&", CLOSE_DIV.sub("", OPEN_DIV.sub("", str(tag))))
+
+
+# Downloads Billboard top 100 list for given week, extracts relevant data.
+# With an archive folder, the page is also saved there for reparse.
+def get_top_songs(date, fetcher, billboard=BILLBOARD, archive=None):
+    date_string = str(date).split()[0]
+    print("Fetching top 100 data for the week of %s..." % (date_string))
+    html = fetcher.get(billboard + "/" + date_string)
+    if archive:
+        with open(archive_file(archive, date_string), "wb") as af:
+            af.write(html)
+    return parse_top_songs(html)
+
+
+def archive_file(archive, date_string):
+    return os.path.join(archive, "hot-100-" + date_string + ".html")
+
+
+# Extracts the songs of a single archived week
+def reparse_week(html_file):
+    with open(html_file, "rb") as hf:
+        return parse_top_songs(hf.read())
+
+
+# Extracts the songs of every archived week in a process pool, writing them
+# to charts.json as a map from week to a list of [title, artist] pairs
+def reparse(archive, path, jobs):
+    weeks = sorted(
+        (
+            f[len("hot-100-"):-len(".html")]
+            for f in os.listdir(archive)
+            if f.startswith("hot-100-") and f.endswith(".html")
+        ),
+        reverse=True
+    )
+    print("Parsing %d archived weeks..." % (len(weeks)))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        charts = executor.map(
+            reparse_week,
+            (archive_file(archive, w) for w in weeks),
+            chunksize=8
         )
-    return zip(s, a)
+        data = {
+            w: [list(song) for song in c] for (w, c) in zip(weeks, charts)
+        }
+    write_to_file(os.path.join(path, "charts.json"), data)
 
 
 # Lyrics from genius.com
-def get_lyrics(genius, artist, title):
+def get_lyrics(genius, artist, title, fetcher):
     artist = artist.lower()
     title = title.lower()
-    while True:
-        try:
-            lyrics_search = genius.search_song(title, artist)
-            break
-        except Exception as e:
-            print("%s, trying again..." % (e))
-            time.sleep(1)
-    if type(lyrics_search) is not None:
+    lyrics_search = fetcher.call(genius.search_song, title, artist)
+    if lyrics_search is not None:
         lyrics = re.sub(r"\[.*?\]", "", lyrics_search.lyrics.lower())
         return lyrics
     else:
         for word in title.split():
-            lyrics_search = genius.search_song(word, artist)
+            lyrics_search = fetcher.call(genius.search_song, word, artist)
             if lyrics_search is not None:
                 return lyrics_search.lyrics
         return ""
 
 
-# Add song data to list - data is all data, tmpdate is only one week's data
-def add_to_data(title, artist, service, genius, data, tmpdata):
-    for song in data:
-        if song["title"] == title and song["artist"] == artist:
-            song[service] += 1
-            tmpdata.append({
-                "title": song["title"],
-                "artist": song["artist"],
-                "lyrics": song["lyrics"]
-            })
-            return
-    lyrics = get_lyrics(genius, artist, title)
-    data.append({
+# Lyrics from the cache if the song was looked up before, else from genius.com
+def get_cached_lyrics(genius, artist, title, fetcher, cache=None):
+    if cache is not None:
+        lyrics = cache.get(title, artist)
+        if lyrics is not None:
+            return lyrics
+    lyrics = get_lyrics(genius, artist, title, fetcher)
+    if cache is not None:
+        cache.put(title, artist, lyrics)
+    return lyrics
+
+
+# Add song data to registry - registry has all data, tmpdate is only one
+# week's data
+def add_to_data(
+    title, artist, service, genius, registry, tmpdata, fetcher, cache=None
+):
+    song = registry.get(title, artist)
+    if song is not None:
+        song[service] += 1
+        tmpdata.append({
+            "title": song["title"],
+            "artist": song["artist"],
+            "lyrics": song["lyrics"]
+        })
+        return
+    lyrics = get_cached_lyrics(genius, artist, title, fetcher, cache)
+    registry.add({
         "title": title,
         "artist": artist,
         service: 1,
@@ -140,27 +219,177 @@ def write_to_file(json_file, data):
             time.sleep(1)
 
 
+# Path of the data file of a single week
+def week_file(path, date_string):
+    return path + "/data" + date_string + ".json"
+
+
+# Append-only JSON Lines record of the weeks whose data file was written
+class Journal:
+    def __init__(self, journal_file, resume=False):
+        self.entries = []
+        if resume and os.path.exists(journal_file):
+            with open(journal_file, "r") as jf:
+                for line in jf:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        # Last line cut short by a crash
+                        break
+        # Rewrite the valid entries, dropping any partial line
+        self.jf = open(journal_file, "w")
+        for entry in self.entries:
+            self.jf.write(json.dumps(entry) + "\n")
+        self.jf.flush()
+
+    def weeks(self):
+        return {entry["week"] for entry in self.entries}
+
+    def record(self, date_string, songs):
+        entry = {"week": date_string, "songs": songs}
+        self.jf.write(json.dumps(entry) + "\n")
+        self.jf.flush()
+        os.fsync(self.jf.fileno())
+        self.entries.append(entry)
+
+    def close(self):
+        self.jf.close()
+
+
+# Rebuilds the data of the weeks in the journal from their data files
+def replay(registry, path, journal, service="billboard"):
+    for entry in journal.entries:
+        with open(week_file(path, entry["week"]), "r") as wf:
+            tmpdata = json.load(wf)
+        for song in tmpdata:
+            known = registry.get(song["title"], song["artist"])
+            if known is not None:
+                known[service] += 1
+            else:
+                registry.add({
+                    "title": song["title"],
+                    "artist": song["artist"],
+                    service: 1,
+                    "lyrics": song["lyrics"]
+                })
+    if len(journal.entries) > 0:
+        print("Resuming after %d completed weeks" % (len(journal.entries)))
+
+
 # Get and save song data
-def scrape(genius, date, weeks, path):
-    data = []
+def scrape(
+    genius,
+    date,
+    weeks,
+    path,
+    fetcher,
+    billboard=BILLBOARD,
+    cache=None,
+    journal=None,
+    archive=None
+):
+    if journal is None:
+        journal = Journal(os.path.join(path, "journal.jsonl"))
+    registry = SongRegistry()
+    replay(registry, path, journal)
+    done = journal.weeks()
     tmpdata = []
     for i in range(weeks):
-        top_songs = get_top_songs(date)
+        date_string = str(date).split()[0]
+        if date_string in done:
+            date -= datetime.timedelta(days=7)
+            continue
+        top_songs = get_top_songs(date, fetcher, billboard, archive)
         for (title, artist) in top_songs:
             add_to_data(
                 genius=genius,
                 title=title,
                 artist=artist,
                 service="billboard",
-                data=data,
-                tmpdata=tmpdata
+                registry=registry,
+                tmpdata=tmpdata,
+                fetcher=fetcher,
+                cache=cache
             )
-        date_string = str(date).split()[0]
         date -= datetime.timedelta(days=7)
         print("Writing json data to file...")
-        write_to_file(path + "/data" + date_string + ".json", tmpdata)
+        write_to_file(week_file(path, date_string), tmpdata)
+        journal.record(date_string, len(tmpdata))
         tmpdata = []
-    write_to_file(path + "/data.json", data)
+    write_to_file(path + "/data.json", registry.data)
+
+
+# Get and save song data, fetching a batch of weeks and then their lyrics in
+# a thread pool. Output is the same as scrape's.
+def scrape_concurrent(
+    genius,
+    date,
+    weeks,
+    path,
+    fetcher,
+    jobs,
+    billboard=BILLBOARD,
+    cache=None,
+    journal=None,
+    archive=None
+):
+    if cache is None:
+        # Without a cache, lookups are only kept for this run
+        cache = LyricsCache(":memory:")
+    if journal is None:
+        journal = Journal(os.path.join(path, "journal.jsonl"))
+    registry = SongRegistry()
+    replay(registry, path, journal)
+    done = journal.weeks()
+    dates = [
+        d for d in (
+            date - datetime.timedelta(days=7 * i) for i in range(weeks)
+        ) if str(d).split()[0] not in done
+    ]
+    batch = jobs * WEEKS_PER_JOB
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for start in range(0, len(dates), batch):
+            batch_dates = dates[start:start + batch]
+            charts = list(executor.map(
+                lambda d: get_top_songs(d, fetcher, billboard, archive),
+                batch_dates
+            ))
+            # Songs that are new to the data, in the order scrape adds them
+            new_songs = {}
+            for top_songs in charts:
+                for (title, artist) in top_songs:
+                    key = song_key(title, artist)
+                    if key not in new_songs and \
+                            registry.get(title, artist) is None and \
+                            cache.get(title, artist) is None:
+                        new_songs[key] = (title, artist)
+            lookups = {
+                executor.submit(
+                    get_lyrics, genius, artist, title, fetcher
+                ): (title, artist) for (title, artist) in new_songs.values()
+            }
+            # Cached from this thread as each lookup completes, so that
+            # finished lookups are kept even if a later one fails
+            for lookup in as_completed(lookups):
+                (title, artist) = lookups[lookup]
+                cache.put(title, artist, lookup.result())
+            for (d, top_songs) in zip(batch_dates, charts):
+                tmpdata = []
+                for (title, artist) in top_songs:
+                    add_to_data(
+                        genius=genius,
+                        title=title,
+                        artist=artist,
+                        service="billboard",
+                        registry=registry,
+                        tmpdata=tmpdata,
+                        fetcher=fetcher,
+                        cache=cache
+                    )
+                date_string = str(d).split()[0]
+                write_to_file(week_file(path, date_string), tmpdata)
+                journal.record(date_string, len(tmpdata))
+    write_to_file(path + "/data.json", registry.data)
 
 
 def main():
@@ -169,6 +398,33 @@ def main():
     parser.add_argument("-s", "--start", help="Starting date (dd-mm-yyyy)")
     parser.add_argument("-o", "--outputpath", help="Set output path")
     parser.add_argument("-g", "--genius", help="Set genius access token")
+    parser.add_argument(
+        "-j", "--jobs", help="Number of concurrent requests (default 1)"
+    )
+    parser.add_argument(
+        "-r", "--rate", help="Maximum requests per second (default 5)"
+    )
+    parser.add_argument(
+        "--retries", help="Retries before a request fails (default 5)"
+    )
+    parser.add_argument("--billboard", help="Billboard chart base url")
+    parser.add_argument("--genius-root", help="Genius base url")
+    parser.add_argument(
+        "-a", "--archive", help="Save the chart page of each week here"
+    )
+    parser.add_argument(
+        "--reparse",
+        action="store_true",
+        help="Extract the songs of the weeks in the archive to charts.json"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a previous scrape from its journal"
+    )
+    parser.add_argument(
+        "-c", "--cache", help="Lyrics cache file (default <output>/lyrics.db)"
+    )
     args = parser.parse_args()
 
     access_token = args.genius if args.genius else \
@@ -177,13 +433,35 @@ def main():
     date = datetime.datetime.strptime(
         args.start, "%d-%m-%Y"
     ) if args.start else datetime.datetime(2019, 9, 7)
-    weeks = args.weeks if args.weeks else 520
+    weeks = int(args.weeks) if args.weeks else 520
+    jobs = int(args.jobs) if args.jobs else 1
+    billboard = args.billboard if args.billboard else BILLBOARD
+    fetcher = Fetcher(
+        rate=float(args.rate) if args.rate else 5.0,
+        retries=int(args.retries) if args.retries else 5
+    )
+
+    if args.reparse:
+        if not args.archive:
+            print("Please provide the path to an archive folder.")
+            sys.exit(1)
+        os.makedirs(path, exist_ok=True)
+        reparse(args.archive, path, jobs if jobs > 1 else os.cpu_count())
+        return
+    if args.archive:
+        os.makedirs(args.archive, exist_ok=True)
 
     try:
         genius = lyricsgenius.Genius(access_token)
     except Exception as e:
         print("%s, could not sign in to Genius." % (e))
         sys.exit(1)
+    if args.genius_root:
+        # Point the Genius client somewhere else, e.g. a local test server
+        root = args.genius_root.rstrip("/") + "/"
+        genius.API_ROOT = root
+        genius.PUBLIC_API_ROOT = root + "api/"
+        genius.WEB_ROOT = root
 
     try:
         os.makedirs(path, exist_ok=True)
@@ -191,12 +469,35 @@ def main():
         print("%s, could not create folder at requested path!" % (e))
         sys.exit(1)
 
-    scrape(
-        genius=genius,
-        date=date,
-        weeks=weeks,
-        path=path
+    cache = LyricsCache(
+        args.cache if args.cache else os.path.join(path, "lyrics.db")
     )
+    journal = Journal(os.path.join(path, "journal.jsonl"), args.resume)
+    if jobs > 1:
+        scrape_concurrent(
+            genius=genius,
+            date=date,
+            weeks=weeks,
+            path=path,
+            fetcher=fetcher,
+            jobs=jobs,
+            billboard=billboard,
+            cache=cache,
+            journal=journal,
+            archive=args.archive
+        )
+    else:
+        scrape(
+            genius=genius,
+            date=date,
+            weeks=weeks,
+            path=path,
+            fetcher=fetcher,
+            billboard=billboard,
+            cache=cache,
+            journal=journal,
+            archive=args.archive
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import html
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from scrape import archive_file, reparse_week
+
+SCRAPE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scrape.py")
+
+CHART_PATH = re.compile(r"^/charts/hot-100/(\d{4}-\d{2}-\d{2})$")
+SONG_PATH = re.compile(r"^/songs/(\d+)$")
+LYRICS_PATH = re.compile(r"^/lyrics/(\d+)$")
+
+# One in this many fixture songs is unknown to Genius, so that the per word
+# fallback searches and cached misses are exercised too
+UNKNOWN_EVERY = 4
+
+
+# Writes a chart page in the format parse_top_songs reads for each week,
+# drawing songs from a small pool so that weeks share most of their songs.
+# Returns the pool.
+def write_chart_pages(pages, date, weeks, songs_per_week, seed=0):
+    state = random.Random(seed)
+    pool = [
+        (
+            "Song %d" % (i),
+            "Artist %d%s" % (i % 7, " & Friend" if i % 5 == 0 else "")
+        ) for i in range(songs_per_week * 3)
+    ]
+    for i in range(weeks):
+        date_string = str(date - datetime.timedelta(days=7 * i)).split()[0]
+        items = "".join(
+            '<div class="item-details__title">%s</div>'
+            '<div class="item-details__artist">%s</div>' % (
+                html.escape(title), html.escape(artist)
+            ) for (title, artist) in state.sample(pool, songs_per_week)
+        )
+        with open(archive_file(pages, date_string), "w") as pf:
+            pf.write("<html><body>%s</body></html>" % (items))
+    return pool
+
+
+# Songs Genius knows about, by the search term get_lyrics sends for them.
+# Lyrics are made up from the title and artist, so every run gets the same.
+def genius_catalog(pool):
+    catalog = {}
+    for (i, (title, artist)) in enumerate(pool):
+        if i % UNKNOWN_EVERY == 0:
+            continue
+        catalog[title.lower() + " " + artist.lower()] = {
+            "id": len(catalog) + 1,
+            "title": title,
+            "primary_artist": {"name": artist},
+            "lyrics_state": "complete",
+            "instrumental": False,
+            "path": "/lyrics/%d" % (len(catalog) + 1),
+            "lyrics": "[Verse]\n%s\nsung by %s\n" % (title, artist)
+        }
+    return catalog
+
+
+# Songs of every chart page saved in an archive folder
+def archived_songs(archive):
+    return {
+        song
+        for f in os.listdir(archive)
+        if f.startswith("hot-100-") and f.endswith(".html")
+        for song in reparse_week(os.path.join(archive, f))
+    }
+
+
+# Answers chart page requests from a folder of saved pages and Genius
+# requests from a catalog, recording when each rate limited call started.
+# After fail_after calls every request fails, to simulate a crash.
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, catalog):
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+        self.pages = pages
+        self.catalog = catalog
+        self.songs = {song["id"]: song for song in catalog.values()}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, fail_after=None):
+        with self.lock:
+            self.calls = []
+            self.fail_after = fail_after
+
+    # Records a call, returning False if it should fail
+    def call(self):
+        with self.lock:
+            self.calls.append(time.monotonic())
+            return self.fail_after is None or \
+                len(self.calls) <= self.fail_after
+
+    def url(self):
+        return "http://127.0.0.1:%d" % (self.server_address[1])
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type="application/json"):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def reply(self, response):
+        self.send(200, json.dumps({"response": response}))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = self.server
+        # Every rate limited call starts with a chart page or a search
+        if CHART_PATH.match(url.path) or url.path == "/api/search/multi":
+            if not server.call():
+                self.send(500, "{}")
+                return
+        chart = CHART_PATH.match(url.path)
+        song = SONG_PATH.match(url.path)
+        lyrics = LYRICS_PATH.match(url.path)
+        if chart:
+            page = archive_file(server.pages, chart.group(1))
+            if not os.path.exists(page):
+                self.send(404, "", "text/html")
+                return
+            with open(page, "r") as pf:
+                self.send(200, pf.read(), "text/html")
+        elif url.path == "/api/search/multi":
+            query = parse_qs(url.query).get("q", [""])[0]
+            found = server.catalog.get(query)
+            hits = [] if found is None else [
+                {"index": "song", "type": "song", "result": found}
+            ]
+            self.reply({"sections": [{"type": "song", "hits": hits}]})
+        elif url.path == "/api/search":
+            self.reply({"hits": []})
+        elif song and int(song.group(1)) in server.songs:
+            found = server.songs[int(song.group(1))]
+            self.reply({"song": dict(
+                found, url="https://genius.com" + found["path"]
+            )})
+        elif lyrics and int(lyrics.group(1)) in server.songs:
+            found = server.songs[int(lyrics.group(1))]
+            self.send(
+                200,
+                "<html><body><div data-lyrics-container=\"true\">%s</div>"
+                "</body></html>" % (
+                    html.escape(found["lyrics"]).replace("\n", "<br/>")
+                ),
+                "text/html"
+            )
+        else:
+            self.send(404, "{}")
+
+
+# Runs scrape.py against the fixture server, returning its exit status
+def run_scrape(server, out, start, weeks, rate, jobs=1, resume=False):
+    command = [
+        sys.executable, SCRAPE,
+        "-w", str(weeks),
+        "-s", start.strftime("%d-%m-%Y"),
+        "-o", out,
+        "-g", "fixture",
+        "-r", str(rate),
+        "-j", str(jobs),
+        "--retries", "0",
+        "--billboard", server.url() + "/charts/hot-100",
+        "--genius-root", server.url()
+    ]
+    if resume:
+        command.append("--resume")
+    with open(out + ".log", "a") as log:
+        return subprocess.call(command, stdout=log, stderr=log)
+
+
+# Data files of a scrape output folder
+def read_output(out):
+    return {
+        f: json.load(open(os.path.join(out, f), "r"))
+        for f in sorted(os.listdir(out)) if f.endswith(".json")
+    }
+
+
+# Largest number of calls started within any second
+def busiest_second(calls):
+    calls = sorted(calls)
+    (most, first) = (0, 0)
+    for (i, t) in enumerate(calls):
+        while t - calls[first] >= 1.0:
+            first += 1
+        most = max(most, i - first + 1)
+    return most
+
+
+# Compares the output of a run with the sequential one, printing differences
+def compare(name, reference, out):
+    output = read_output(out)
+    differences = sorted(
+        f for f in set(reference) | set(output)
+        if reference.get(f) != output.get(f)
+    )
+    for f in differences:
+        print("%s: %s differs from the sequential run" % (name, f))
+    return len(differences) == 0
+
+
+# Checks a run's calls kept to rate, allowing one call of jitter
+def check_rate(name, server, rate):
+    most = busiest_second(server.calls)
+    if most > int(rate) + 1:
+        print("%s: %d calls within a second, limit is %g" % (name, most, rate))
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Checks that concurrent and resumed runs of scrape.py "
+        "write the same output as a sequential run, against a local "
+        "Billboard and Genius fixture server"
+    )
+    parser.add_argument("-w", "--weeks", help="Number of weeks (default 8)")
+    parser.add_argument(
+        "-n", "--songs", help="Songs per chart week (default 10)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="Threads of the concurrent run (default 4)"
+    )
+    parser.add_argument(
+        "-r", "--rate", help="Maximum requests per second (default 20)"
+    )
+    parser.add_argument(
+        "-a", "--archive",
+        help="Serve the chart pages saved by scrape.py -a here instead of "
+        "made up ones"
+    )
+    parser.add_argument(
+        "-s", "--start",
+        help="Starting date of the archived weeks (dd-mm-yyyy)"
+    )
+    parser.add_argument(
+        "-o", "--outputpath",
+        help="Keep the outputs here (default a temporary folder)"
+    )
+    args = parser.parse_args()
+
+    weeks = int(args.weeks) if args.weeks else 8
+    songs_per_week = int(args.songs) if args.songs else 10
+    jobs = int(args.jobs) if args.jobs else 4
+    rate = float(args.rate) if args.rate else 20.0
+    start = datetime.datetime.strptime(
+        args.start, "%d-%m-%Y"
+    ) if args.start else datetime.datetime(2019, 9, 7)
+    path = args.outputpath if args.outputpath else tempfile.mkdtemp()
+    os.makedirs(path, exist_ok=True)
+
+    if args.archive:
+        pages = args.archive
+        pool = archived_songs(pages)
+    else:
+        pages = os.path.join(path, "pages")
+        os.makedirs(pages, exist_ok=True)
+        pool = write_chart_pages(pages, start, weeks, songs_per_week)
+    server = FixtureServer(pages, genius_catalog(sorted(pool)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Serving %s on %s" % (pages, server.url()))
+
+    ok = True
+    runs = [
+        ("sequential", 1, False),
+        ("concurrent", jobs, False),
+        ("resumed sequential", 1, True),
+        ("resumed concurrent", jobs, True)
+    ]
+    (reference, reference_calls) = (None, 0)
+    for (name, run_jobs, crash) in runs:
+        out = os.path.join(path, name.replace(" ", "_"))
+        # Lookups cached by an earlier check would keep the run from crashing
+        if os.path.exists(out):
+            shutil.rmtree(out)
+        if os.path.exists(out + ".log"):
+            os.remove(out + ".log")
+        server.reset()
+        if crash:
+            # Fail half way through the calls of a whole run, then resume
+            server.reset(fail_after=reference_calls // 2)
+            status = run_scrape(server, out, start, weeks, rate, run_jobs)
+            if status == 0:
+                print("%s: the run did not crash" % (name))
+                ok = False
+            server.reset()
+            status = run_scrape(
+                server, out, start, weeks, rate, run_jobs, resume=True
+            )
+        else:
+            status = run_scrape(server, out, start, weeks, rate, run_jobs)
+        if status != 0:
+            print("%s: scrape.py failed, see %s.log" % (name, out))
+            ok = False
+            continue
+        print("%s: %d calls" % (name, len(server.calls)))
+        ok = check_rate(name, server, rate) and ok
+        if reference is None:
+            reference = read_output(out)
+            reference_calls = len(server.calls)
+        else:
+            ok = compare(name, reference, out) and ok
+    server.shutdown()
+    print("All outputs match" if ok else "Outputs differ")
+    print("Outputs are in %s" % (path))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
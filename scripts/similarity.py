@@ -0,0 +1,401 @@
+import json
+import logging
+import os
+import time
+import numpy as np
+from store import modelKey
+from tables import TABLE_SUFFIX
+
+# Number of indexed vectors compared with the queries at a time
+SIMILARITY_BLOCK = 8192
+
+# Hash tables of the approximate search, each with its own random planes
+LSH_TABLES = 16
+
+# Average number of vectors per bucket the number of planes is chosen for
+LSH_BUCKET = 8
+
+# Songs used as queries when comparing approximate and exact search
+EVALUATION_QUERIES = 500
+
+
+def indexFiles(path):
+    '''
+    Returns the paths of the song vectors, artist vectors, sidecar and hash
+    codes of a similarity index
+    '''
+    return (
+        path + ".songs" + TABLE_SUFFIX,
+        path + ".artists" + TABLE_SUFFIX,
+        path + ".meta.json",
+        path + ".lsh.npz"
+    )
+
+
+def normalize(matrix):
+    '''
+    Scales rows to unit length in single precision, leaving zero rows alone,
+    so that dot products are cosine similarities
+    '''
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def topK(queries, matrix, k, exclude=None):
+    '''
+    Exact top k cosine search of normalized queries against a normalized
+    matrix, one block of rows at a time. exclude gives a row to leave out
+    for each query (or -1), e.g. the query itself. Returns the row ids and
+    scores of the best matches of each query, best first. k is capped to
+    the rows left to match, so excluded rows are never returned.
+    '''
+    if exclude is not None and np.any(exclude >= 0):
+        k = min(k, len(matrix) - 1)
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(matrix), SIMILARITY_BLOCK):
+        block = np.asarray(matrix[start:start + SIMILARITY_BLOCK])
+        scores = queries @ block.T
+        if exclude is not None:
+            inside = (exclude >= start) & (exclude < start + len(block))
+            scores[np.nonzero(inside)[0], exclude[inside] - start] = -np.inf
+        ids = np.broadcast_to(
+            np.arange(start, start + len(block)), scores.shape
+        )
+        best_ids = np.hstack([best_ids, ids])
+        best_scores = np.hstack([best_scores, scores])
+        if best_scores.shape[1] > k:
+            keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_ids = np.take_along_axis(best_ids, keep, axis=1)
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return (
+        np.take_along_axis(best_ids, order, axis=1),
+        np.take_along_axis(best_scores, order, axis=1)
+    )
+
+
+class HashTables:
+    '''
+    Random projection hashes of normalized vectors: each table hashes a
+    vector to the side of a set of random planes it falls on, so vectors
+    with a small angle between them tend to share buckets. Candidates from
+    every table are then ranked exactly. Song means all point in much the
+    same direction, so vectors are hashed relative to their mean, or the
+    planes through the origin would put nearly all of them in one bucket.
+    '''
+
+    def __init__(self, planes, codes, mean):
+        self.planes = planes
+        self.codes = codes
+        self.mean = mean
+        # Rows sorted by code in each table, so buckets are contiguous
+        self.order = np.argsort(codes, axis=1, kind="stable")
+        self.sorted = np.take_along_axis(codes, self.order, axis=1)
+
+    @classmethod
+    def build(cls, matrix, seed=0):
+        bits = int(np.clip(np.log2(max(len(matrix), 1) / LSH_BUCKET), 1, 62))
+        planes = np.random.RandomState(seed).randn(
+            LSH_TABLES, bits, matrix.shape[1]
+        ).astype(np.float32)
+        total = np.zeros(matrix.shape[1])
+        for start in range(0, len(matrix), SIMILARITY_BLOCK):
+            total += np.sum(
+                np.asarray(matrix[start:start + SIMILARITY_BLOCK], np.float64),
+                axis=0
+            )
+        mean = (total / max(len(matrix), 1)).astype(np.float32)
+        return cls(planes, cls.hash(planes, matrix, mean), mean)
+
+    @staticmethod
+    def hash(planes, matrix, mean):
+        powers = 1 << np.arange(planes.shape[1], dtype=np.int64)
+        codes = np.empty((len(planes), len(matrix)), dtype=np.int64)
+        for start in range(0, len(matrix), SIMILARITY_BLOCK):
+            block = np.asarray(matrix[start:start + SIMILARITY_BLOCK]) - mean
+            for (t, table) in enumerate(planes):
+                codes[t, start:start + len(block)] = \
+                    ((block @ table.T) > 0) @ powers
+        return codes
+
+    def candidates(self, queries):
+        codes = self.hash(self.planes, queries, self.mean)
+        for q in range(len(queries)):
+            found = []
+            for t in range(len(self.planes)):
+                low = np.searchsorted(self.sorted[t], codes[t, q], "left")
+                high = np.searchsorted(self.sorted[t], codes[t, q], "right")
+                found.append(self.order[t, low:high])
+            yield np.unique(np.concatenate(found))
+
+
+def approximateTopK(queries, matrix, tables, k, exclude=None):
+    '''
+    Top k search among the vectors that share a bucket with each query in
+    any of the hash tables. Queries with fewer candidates than k get fewer
+    matches, padded with -1 ids.
+    '''
+    ids = np.full((len(queries), k), -1, dtype=np.int64)
+    scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    sizes = []
+    for (q, found) in enumerate(tables.candidates(queries)):
+        if exclude is not None:
+            found = found[found != exclude[q]]
+        sizes.append(len(found))
+        if len(found) == 0:
+            continue
+        found_scores = np.asarray(matrix[found]) @ queries[q]
+        order = np.argsort(-found_scores, kind="stable")[:k]
+        ids[q, :len(order)] = found[order]
+        scores[q, :len(order)] = found_scores[order]
+    return (ids, scores, sizes)
+
+
+class SimilarityIndex:
+    '''
+    Normalized song and artist vectors of a vectors table, along with hash
+    tables for approximate search, saved to disk so that queries do not
+    need the table again
+    '''
+
+    def __init__(self, songs, artists, names, offsets, titles, lsh=None):
+        self.songs = songs
+        self.artists = artists
+        self.names = names
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.titles = titles
+        self.lsh = lsh
+        self.owners = np.repeat(np.arange(len(names)), np.diff(self.offsets))
+
+    @classmethod
+    def build(cls, vectors):
+        logging.info("Building similarity index")
+        songs = np.empty(vectors.matrix.shape, dtype=np.float32)
+        for start in range(0, len(songs), SIMILARITY_BLOCK):
+            songs[start:start + SIMILARITY_BLOCK] = normalize(
+                vectors.matrix[start:start + SIMILARITY_BLOCK]
+            )
+        index = cls(
+            songs,
+            normalize(vectors.centers),
+            vectors.names,
+            vectors.offsets,
+            vectors.titles
+        )
+        logging.info("Hashing index vectors")
+        index.lsh = {
+            "songs": HashTables.build(index.songs, seed=0),
+            "artists": HashTables.build(index.artists, seed=1)
+        }
+        return index
+
+    def save(self, path, source):
+        (songs_file, artists_file, meta_file, lsh_file) = indexFiles(path)
+        np.save(songs_file, self.songs)
+        np.save(artists_file, self.artists)
+        np.savez(
+            lsh_file,
+            song_planes=self.lsh["songs"].planes,
+            song_codes=self.lsh["songs"].codes,
+            song_mean=self.lsh["songs"].mean,
+            artist_planes=self.lsh["artists"].planes,
+            artist_codes=self.lsh["artists"].codes,
+            artist_mean=self.lsh["artists"].mean
+        )
+        # The sidecar is written last, as it marks complete indexes
+        with open(meta_file, "w") as mf:
+            json.dump(
+                {
+                    "source": source,
+                    "names": self.names,
+                    "offsets": self.offsets.tolist(),
+                    "titles": self.titles,
+                },
+                mf
+            )
+
+    @classmethod
+    def load(cls, path, source=None):
+        '''
+        Loads an index with its vectors memory mapped, or returns None if
+        it is missing or was built from a different source
+        '''
+        (songs_file, artists_file, meta_file, lsh_file) = indexFiles(path)
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file, "r") as mf:
+            meta = json.load(mf)
+        if source is not None and meta["source"] != source:
+            return None
+        with np.load(lsh_file) as lf:
+            # Indexes hashed around the origin are built again
+            if "song_mean" not in lf.files:
+                return None
+            lsh = {
+                "songs": HashTables(
+                    lf["song_planes"], lf["song_codes"], lf["song_mean"]
+                ),
+                "artists": HashTables(
+                    lf["artist_planes"], lf["artist_codes"], lf["artist_mean"]
+                )
+            }
+        return cls(
+            np.load(songs_file, mmap_mode="r"),
+            np.load(artists_file, mmap_mode="r"),
+            meta["names"],
+            meta["offsets"],
+            meta["titles"],
+            lsh
+        )
+
+    def song(self, i):
+        return {
+            "artist": self.names[self.owners[i]],
+            "title": self.titles[self.owners[i]][i - self.offsets[
+                self.owners[i]
+            ]] if self.titles is not None else None
+        }
+
+    def find(self, query):
+        '''
+        Resolves an "artist" or "artist/title" query to an artist or song
+        row, ignoring case. Names and titles may hold slashes themselves
+        (e.g. "AC/DC"), so the whole query is tried as an artist first, then
+        every split at a slash.
+        '''
+        lowered = [name.lower() for name in self.names]
+        query = query.lower()
+        if query in lowered:
+            return ("artists", lowered.index(query))
+        for (i, c) in enumerate(query):
+            if c != "/" or query[:i] not in lowered:
+                continue
+            a = lowered.index(query[:i])
+            titles = [
+                t.lower() for t in (self.titles[a] if self.titles else [])
+            ]
+            if query[i + 1:] in titles:
+                return (
+                    "songs", int(self.offsets[a]) + titles.index(query[i + 1:])
+                )
+        return (None, None)
+
+    def search(self, kind, rows, k, approximate=False):
+        '''
+        Returns the k nearest artists or songs of the given rows of the
+        index, leaving out each row itself
+        '''
+        matrix = self.songs if kind == "songs" else self.artists
+        rows = np.asarray(rows, dtype=np.int64)
+        queries = np.asarray(matrix[rows])
+        if approximate:
+            (ids, scores, _) = approximateTopK(
+                queries, matrix, self.lsh[kind], k, rows
+            )
+        else:
+            (ids, scores) = topK(queries, matrix, k, rows)
+        return (ids, scores)
+
+
+def describe(index, kind, ids, scores):
+    out = []
+    for (i, score) in zip(ids, scores):
+        # Padding of queries with fewer matches than asked for
+        if i < 0 or not np.isfinite(score):
+            continue
+        match = {"name": index.names[i]} if kind == "artists" \
+            else index.song(i)
+        match["score"] = float(score)
+        out.append(match)
+    return out
+
+
+def evaluate(index, kind, k, seed=0):
+    '''
+    Compares approximate and exact search on a sample of the index's own
+    vectors, reporting the recall of the approximate search and the mean
+    latency per query of both
+    '''
+    matrix = index.songs if kind == "songs" else index.artists
+    rows = np.random.RandomState(seed).permutation(len(matrix))[
+        :EVALUATION_QUERIES
+    ]
+    begin = time.perf_counter()
+    (exact, _) = index.search(kind, rows, k)
+    exact_seconds = time.perf_counter() - begin
+    begin = time.perf_counter()
+    (approximate, _, sizes) = approximateTopK(
+        np.asarray(matrix[rows]), matrix, index.lsh[kind], k, rows
+    )
+    approximate_seconds = time.perf_counter() - begin
+    found = [
+        len(set(a[a >= 0]) & set(e)) / len(e)
+        for (a, e) in zip(approximate, exact) if len(e) > 0
+    ]
+    report = {
+        "queries": len(rows),
+        "k": k,
+        "recall": float(np.mean(found)) if found else None,
+        "mean_candidates": float(np.mean(sizes)) if sizes else 0.0,
+        "exact_seconds_per_query": exact_seconds / max(len(rows), 1),
+        "approximate_seconds_per_query":
+            approximate_seconds / max(len(rows), 1),
+    }
+    logging.info(
+        "%s: recall@%d %.3f, %.1f candidates per query, "
+        "%.3fms exact, %.3fms approximate per query" % (
+            kind, k, report["recall"] or 0.0, report["mean_candidates"],
+            1000 * report["exact_seconds_per_query"],
+            1000 * report["approximate_seconds_per_query"]
+        )
+    )
+    return report
+
+
+def findSimilar(
+    vectors_file,
+    vectors,
+    index_file,
+    queries,
+    k,
+    approximate=False,
+    evaluation=False
+):
+    '''
+    Answers "artist" and "artist/title" queries (every artist when there
+    are none) with the k most similar artists or songs. The index of
+    vectors_file is built first, with the table returned by vectors, if it
+    is missing or out of date.
+    '''
+    # Files are told apart by path, size and modification time
+    source = modelKey(vectors_file)
+    index = SimilarityIndex.load(index_file, source)
+    if index is None:
+        index = SimilarityIndex.build(vectors())
+        index.save(index_file, source)
+    if not queries:
+        queries = list(index.names)
+    rows = {"artists": [], "songs": []}
+    for query in queries:
+        (kind, row) = index.find(query)
+        if kind is None:
+            logging.warning("%s not found in the index" % (query))
+            continue
+        rows[kind].append((query, row))
+    out = {"artists": {}, "songs": {}}
+    for (kind, found) in rows.items():
+        if len(found) == 0:
+            continue
+        (ids, scores) = index.search(
+            kind, [row for (_, row) in found], k, approximate
+        )
+        for ((query, _), i, s) in zip(found, ids, scores):
+            out[kind][query] = describe(index, kind, i, s)
+    if evaluation:
+        out["evaluation"] = {
+            kind: evaluate(index, kind, k) for kind in ("artists", "songs")
+        }
+    return out
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import sqlite3
+import numpy as np
+
+# Number of keys looked up per query, below SQLite's variable limit
+QUERY_BATCH = 500
+
+
+def songKey(settings, lyrics):
+    '''
+    Key of a song's filtered lyrics: a hash of the raw lyrics and of the
+    filter settings they were filtered with
+    '''
+    return hashlib.sha1(
+        (settings + "\0" + lyrics).encode("utf-8")
+    ).hexdigest()
+
+
+def textKey(text):
+    '''
+    Key of an already filtered text
+    '''
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def fileKey(path):
+    '''
+    Hash of a file's contents
+    '''
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def modelKey(model_file):
+    '''
+    Identifies a model file by path, size and modification time
+    '''
+    stat = os.stat(model_file)
+    return hashlib.sha1(
+        (
+            "%s\0%d\0%d" % (
+                os.path.abspath(model_file), stat.st_size, stat.st_mtime_ns
+            )
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+class CorpusStore:
+    '''
+    On-disk store of filtered lyrics and of their vocabulary ids in each
+    embedding model, so that unchanged songs are never processed twice
+    '''
+
+    def __init__(self, store_file):
+        self.connection = sqlite3.connect(store_file)
+        self.connection.executescript(
+            '''
+            CREATE TABLE IF NOT EXISTS tokens (
+                key TEXT PRIMARY KEY,
+                lyrics TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS ids (
+                model TEXT NOT NULL,
+                key TEXT NOT NULL,
+                ids BLOB NOT NULL,
+                PRIMARY KEY (model, key)
+            );
+            '''
+        )
+
+    def select(self, query, keys, params=()):
+        found = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), QUERY_BATCH):
+            batch = keys[i:i + QUERY_BATCH]
+            rows = self.connection.execute(
+                query % (",".join("?" * len(batch))),
+                tuple(params) + tuple(batch)
+            )
+            for (key, value) in rows:
+                found[key] = value
+        return found
+
+    def getTokens(self, keys):
+        '''
+        Returns the filtered lyrics stored for the given keys
+        '''
+        return self.select(
+            "SELECT key, lyrics FROM tokens WHERE key IN (%s)", keys
+        )
+
+    def putTokens(self, items):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tokens VALUES (?, ?)", items
+            )
+
+    def getIds(self, model, keys):
+        '''
+        Returns the vocabulary ids stored for the given keys in a model
+        '''
+        return {
+            key: np.frombuffer(ids, dtype=np.int32)
+            for (key, ids) in self.select(
+                "SELECT key, ids FROM ids WHERE model = ? AND key IN (%s)",
+                keys,
+                (model,)
+            ).items()
+        }
+
+    def putIds(self, model, items):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO ids VALUES (?, ?, ?)",
+                (
+                    (model, key, np.asarray(ids, dtype=np.int32).tobytes())
+                    for (key, ids) in items
+                )
+            )
+
+    def close(self):
+        self.connection.close()
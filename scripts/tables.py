@@ -0,0 +1,329 @@
+import json
+import os
+import numpy as np
+
+# Extension of the matrix file of a binary table
+TABLE_SUFFIX = ".npy"
+
+# Kinds of tables written by the analysis stages
+VECTORS = "vectors"
+DEVIATIONS = "deviations"
+AVG_DEVIATIONS = "avg_deviations"
+
+
+def isTable(path):
+    return path.endswith(TABLE_SUFFIX)
+
+
+def tableFiles(path):
+    '''
+    Returns the paths of the matrix, centers and sidecar of a binary table
+    '''
+    base = path[:-len(TABLE_SUFFIX)] if isTable(path) else path
+    return (
+        base + TABLE_SUFFIX,
+        base + ".centers" + TABLE_SUFFIX,
+        base + ".meta.json"
+    )
+
+
+def statsFile(path):
+    '''
+    Returns the path of the summary statistics saved with a table: vector
+    sums and song keys of vectors, versions of deviations
+    '''
+    base = path[:-len(TABLE_SUFFIX)] if isTable(path) else path
+    return base + ".stats.npz"
+
+
+def getOffsets(counts):
+    return np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+
+def saveStats(path, stats):
+    if stats is not None:
+        # Everything but vector sums is a list of strings
+        np.savez(
+            statsFile(path),
+            **{
+                key: value if key == "sums" else np.array(value, dtype=str)
+                for (key, value) in stats.items()
+            }
+        )
+    elif os.path.exists(statsFile(path)):
+        # Statistics of an older table no longer match its rows
+        os.remove(statsFile(path))
+
+
+def saveMeta(path, kind, names, offsets, titles):
+    '''
+    Writes the sidecar of a binary table, last, as it marks complete tables
+    '''
+    with open(tableFiles(path)[2], "w") as mf:
+        json.dump(
+            {
+                "kind": kind,
+                "names": names,
+                "offsets": np.asarray(offsets).tolist(),
+                "titles": titles,
+            },
+            mf
+        )
+
+
+class Table:
+    '''
+    Rows of every artist (song vectors, song deviations or average
+    deviations) stored as one matrix, where the rows of artist i are
+    matrix[offsets[i]:offsets[i + 1]]. Vectors tables also hold the center
+    of each artist, and optionally summary statistics used to update them:
+    the vector sum of each artist ("sums"), a key for each song ("keys"),
+    the names of the artists that changed in the last update ("changed")
+    and what the rows were worked out with ("producer").
+    '''
+
+    def __init__(
+        self,
+        kind,
+        names,
+        offsets,
+        matrix,
+        centers=None,
+        titles=None,
+        stats=None
+    ):
+        self.kind = kind
+        self.names = list(names)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.matrix = matrix
+        self.centers = centers
+        self.titles = titles
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.names)
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def rows(self, i):
+        return self.matrix[self.offsets[i]:self.offsets[i + 1]]
+
+    def part(self, start, end):
+        '''
+        Returns the artists from start to end as a table sharing this one's
+        matrices, so parts of mapped tables are only read when used
+        '''
+        stats = None
+        if self.stats is not None:
+            names = set(self.names[start:end])
+            stats = {
+                "sums": self.stats["sums"][start:end],
+                "keys": self.stats["keys"][
+                    self.offsets[start]:self.offsets[end]
+                ],
+                "changed": [n for n in self.stats["changed"] if n in names],
+                "producer": self.stats.get("producer", [])
+            } if self.kind == VECTORS else {
+                "versions": self.stats["versions"][start:end]
+            }
+        return Table(
+            self.kind,
+            self.names[start:end],
+            self.offsets[start:end + 1] - self.offsets[start],
+            self.matrix[self.offsets[start]:self.offsets[end]],
+            self.centers[start:end] if self.centers is not None else None,
+            self.titles[start:end] if self.titles is not None else None,
+            stats
+        )
+
+    def parts(self, size):
+        for start in range(0, len(self), size):
+            yield self.part(start, min(start + size, len(self)))
+
+    @classmethod
+    def fromRows(cls, kind, names, rows, centers=None, titles=None):
+        '''
+        Stacks a list of per-artist row lists into a table
+        '''
+        counts = [len(r) for r in rows]
+        columns = len(centers[0]) if centers is not None and \
+            len(centers) > 0 else 1
+        matrix = np.array(
+            [row for r in rows for row in r], dtype=np.float64
+        ).reshape(-1, columns)
+        if centers is not None:
+            centers = np.array(centers, dtype=np.float64).reshape(
+                len(names), columns
+            )
+        return cls(kind, names, getOffsets(counts), matrix, centers, titles)
+
+    @classmethod
+    def fromJson(cls, data):
+        '''
+        Builds a table from the JSON output of an analysis stage
+        '''
+        if len(data) > 0 and "vectors" in data[0]:
+            return cls.fromRows(
+                VECTORS,
+                [v["artist"] for v in data],
+                [v["vectors"] for v in data],
+                centers=[v["center"] for v in data]
+            )
+        if len(data) > 0 and "average_deviation" in data[0]:
+            return cls.fromRows(
+                AVG_DEVIATIONS,
+                [a["name"] for a in data],
+                [[a["average_deviation"]] for a in data]
+            )
+        return cls.fromRows(
+            DEVIATIONS,
+            [a["name"] for a in data],
+            [a["deviations"] for a in data]
+        )
+
+    def toJson(self):
+        '''
+        Returns the table in the JSON format of the analysis stages
+        '''
+        if self.kind == VECTORS:
+            return [
+                {
+                    "artist": self.names[i],
+                    "center": self.centers[i].tolist(),
+                    "vectors": self.rows(i).tolist()
+                } for i in range(len(self))
+            ]
+        if self.kind == AVG_DEVIATIONS:
+            return [
+                {
+                    "name": self.names[i],
+                    "average_deviation": self.matrix[i].tolist()
+                } for i in range(len(self))
+            ]
+        return [
+            {
+                "name": self.names[i],
+                "deviations": self.rows(i).tolist()
+            } for i in range(len(self))
+        ]
+
+    def save(self, path):
+        (matrix_file, centers_file, _) = tableFiles(path)
+        np.save(matrix_file, self.matrix)
+        if self.centers is not None:
+            np.save(centers_file, self.centers)
+        saveStats(path, self.stats)
+        saveMeta(path, self.kind, self.names, self.offsets, self.titles)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Loads a binary table. The matrices are memory mapped read-only
+        unless mmap is False, so rows are only read when used.
+        '''
+        (matrix_file, centers_file, meta_file) = tableFiles(path)
+        mode = "r" if mmap else None
+        with open(meta_file, "r") as mf:
+            meta = json.load(mf)
+        centers = np.load(centers_file, mmap_mode=mode) \
+            if meta["kind"] == VECTORS else None
+        stats = None
+        if os.path.exists(statsFile(path)):
+            with np.load(statsFile(path)) as sf:
+                stats = {
+                    key: sf[key] if key == "sums" else sf[key].tolist()
+                    for key in sf.files
+                }
+        return cls(
+            meta["kind"],
+            meta["names"],
+            meta["offsets"],
+            np.load(matrix_file, mmap_mode=mode),
+            centers,
+            meta.get("titles"),
+            stats
+        )
+
+
+class TableWriter:
+    '''
+    Writes a binary table a few artists at a time into memory mapped
+    matrices of a known size, so that only the artists being written are
+    ever held in memory. The sidecar is written by close, so an unfinished
+    table is never taken for a complete one.
+    '''
+
+    def __init__(self, path, kind, artists, rows, columns):
+        self.path = path
+        self.kind = kind
+        (matrix_file, centers_file, meta_file) = tableFiles(path)
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        self.matrix = np.lib.format.open_memmap(
+            matrix_file, mode="w+", dtype=np.float64, shape=(rows, columns)
+        )
+        self.centers = np.lib.format.open_memmap(
+            centers_file, mode="w+", dtype=np.float64,
+            shape=(artists, columns)
+        ) if kind == VECTORS else None
+        self.names = []
+        self.counts = []
+        self.titles = []
+        self.stats = {}
+
+    def append(self, table):
+        (row, artist) = (sum(self.counts), len(self.names))
+        self.matrix[row:row + len(table.matrix)] = table.matrix
+        if self.centers is not None:
+            self.centers[artist:artist + len(table)] = table.centers
+        self.names.extend(table.names)
+        self.counts.extend(table.counts().tolist())
+        if self.titles is not None and table.titles is not None:
+            self.titles.extend(table.titles)
+        else:
+            self.titles = None
+        if self.stats is not None and table.stats is not None:
+            for (key, value) in table.stats.items():
+                if key == "sums":
+                    self.stats.setdefault(key, []).append(value)
+                elif key == "producer":
+                    # Every part was worked out the same way
+                    self.stats[key] = list(value)
+                else:
+                    self.stats.setdefault(key, []).extend(value)
+        else:
+            self.stats = None
+
+    def close(self):
+        '''
+        Flushes the matrices and writes the sidecar, returning the table
+        '''
+        self.matrix.flush()
+        if self.centers is not None:
+            self.centers.flush()
+        if not self.stats:
+            self.stats = None
+        elif "sums" in self.stats:
+            self.stats["sums"] = np.concatenate(self.stats["sums"])
+        saveStats(self.path, self.stats)
+        saveMeta(
+            self.path,
+            self.kind,
+            self.names,
+            getOffsets(self.counts),
+            self.titles
+        )
+        del self.matrix
+        del self.centers
+        return Table.load(self.path)
+
+
+def readTable(path):
+    '''
+    Reads the output of an analysis stage, binary or JSON, as a table
+    '''
+    if isTable(path):
+        return Table.load(path)
+    with open(path, "r") as df:
+        return Table.fromJson(json.load(df))
@@ -2,31 +2,157 @@
 
 import json
 import argparse
+import heapq
+import os
+import re
+from collections import Counter, deque
+
+# Weekly data files written by scrape.py
+WEEK_FILE = re.compile(r"^data(\d{4}-\d{2}-\d{2})\.json$")
 
 
 def sort_artists(data):
-    artists = []
+    appearances = {}
     for song in data:
-        insert = True
-        for artist in artists:
-            if artist["name"] == song["artist"]:
-                artist["appearances"] += song["billboard"]
-                insert = False
-        if insert:
-            artists.append(
-                {"name": song["artist"], "appearances": song["billboard"]}
-            )
+        appearances[song["artist"]] = \
+            appearances.get(song["artist"], 0) + song["billboard"]
+    artists = [
+        {"name": name, "appearances": count}
+        for (name, count) in appearances.items()
+    ]
     artists = sorted(artists, key=lambda artist: artist["appearances"])
     artists.reverse()
     return artists
 
 
+def top_k(counts, k):
+    return [
+        {"name": name, "appearances": count}
+        for (name, count) in heapq.nlargest(
+            k, counts.items(), key=lambda item: (item[1], item[0])
+        )
+    ]
+
+
+# Appearance counts over the weekly chart files, kept up to date as new
+# weeks are added. Only per-week counts are stored besides the totals, so
+# adding weeks never needs to read the old files again.
+class ChartStats:
+    def __init__(self, state=None):
+        state = state if state is not None else {}
+        self.weeks = {
+            week: Counter(counts)
+            for (week, counts) in state.get("weeks", {}).items()
+        }
+        self.all_time = Counter(state.get("all_time", {}))
+        self.years = {
+            year: Counter(counts)
+            for (year, counts) in state.get("years", {}).items()
+        }
+
+    def add_week(self, week, songs):
+        if week in self.weeks:
+            return False
+        counts = Counter(song["artist"] for song in songs)
+        self.weeks[week] = counts
+        self.all_time.update(counts)
+        self.years.setdefault(week[:4], Counter()).update(counts)
+        return True
+
+    # Reads the weekly files in path that have not been counted yet
+    def update(self, path):
+        added = 0
+        for week_file in sorted(os.listdir(path)):
+            match = WEEK_FILE.match(week_file)
+            if match is None or match.group(1) in self.weeks:
+                continue
+            with open(os.path.join(path, week_file), "r") as wf:
+                added += self.add_week(match.group(1), json.load(wf))
+        return added
+
+    # Counts over the window weeks ending at each week, sliding the window
+    # one week at a time
+    def rolling(self, window, k):
+        counts = Counter()
+        current = deque()
+        out = {}
+        for week in sorted(self.weeks):
+            counts.update(self.weeks[week])
+            current.append(week)
+            if len(current) > window:
+                for (name, count) in self.weeks[current.popleft()].items():
+                    counts[name] -= count
+                    if counts[name] <= 0:
+                        del counts[name]
+            out[week] = top_k(counts, k)
+        return out
+
+    def state(self):
+        return {
+            "weeks": self.weeks,
+            "all_time": self.all_time,
+            "years": self.years,
+        }
+
+    def summary(self, window, k):
+        return {
+            "all_time": sorted(
+                (
+                    {"name": name, "appearances": count}
+                    for (name, count) in self.all_time.items()
+                ),
+                key=lambda artist: (-artist["appearances"], artist["name"])
+            ),
+            "top": top_k(self.all_time, k),
+            "years": {
+                year: top_k(counts, k)
+                for (year, counts) in sorted(self.years.items())
+            },
+            "rolling": self.rolling(window, k),
+        }
+
+
+def chart_stats(path, state_file, window, k):
+    state = None
+    if os.path.exists(state_file):
+        with open(state_file, "r") as sf:
+            state = json.load(sf)
+    stats = ChartStats(state)
+    print("Added %d new weeks" % (stats.update(path)))
+    with open(state_file, "w") as sf:
+        json.dump(stats.state(), sf)
+    return stats.summary(window, k)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--data", help="Data file")
     parser.add_argument("-o", "--output", help="Output file")
+    parser.add_argument(
+        "-p", "--path", help="Folder of weekly data files, for chart stats"
+    )
+    parser.add_argument(
+        "-s", "--state", help="Chart stats state file (default in path)"
+    )
+    parser.add_argument("-w", "--window", help="Rolling window in weeks")
+    parser.add_argument("-k", "--top", help="Number of top artists")
     args = parser.parse_args()
 
+    if args.path:
+        output_path = args.output if args.output else "chart_stats.json"
+        state_file = args.state if args.state else \
+            os.path.join(args.path, "chart_stats_state.json")
+        output = chart_stats(
+            args.path,
+            state_file,
+            int(args.window) if args.window else 52,
+            int(args.top) if args.top else 10
+        )
+        print(output["top"])
+        with open(output_path, "w") as of:
+            json.dump(output, of)
+        return
+
     if not args.data:
         print("Please provide the path to a valid data file.")
 
@@ -0,0 +1,183 @@
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Counters reported per second of wall time
+RATE_COUNTERS = ("songs", "tokens")
+
+
+def maxRss():
+    '''
+    Peak resident memory of this process so far, in bytes
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Span:
+    '''
+    A timed step of a run, with counters such as songs or tokens and the
+    steps it is made of
+    '''
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.counters = {}
+        self.children = []
+        self.timings = {}
+        # Highest traced memory seen while this span was open
+        self.peak = 0
+
+    def count(self, **counters):
+        for (key, value) in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def toJson(self):
+        out = {"name": self.name}
+        out.update(self.timings)
+        out["counters"] = dict(self.counters)
+        seconds = out.get("wall_seconds", 0.0)
+        for key in RATE_COUNTERS:
+            if seconds > 0 and key in self.counters:
+                out["counters"][key + "_per_second"] = \
+                    self.counters[key] / seconds
+        if "oov" in self.counters and self.counters.get("tokens"):
+            out["counters"]["oov_rate"] = \
+                self.counters["oov"] / self.counters["tokens"]
+        out["children"] = [child.toJson() for child in self.children]
+        return out
+
+
+class Tracer:
+    '''
+    Records the wall time, CPU time and memory of nested steps of a run.
+    Disabled tracers hand out spans that are never recorded, so
+    instrumented code costs next to nothing unless a trace is asked for.
+    Steps whose name is in profile (or every step, with "all") are also run
+    under cProfile, and their statistics saved next to the trace.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.label = None
+        self.trace_file = None
+        self.profile = set()
+        self.memory = False
+        self.roots = []
+        self.stack = []
+        self.profiling = False
+        self.start = time.perf_counter()
+
+    def enable(self, trace_file, profile=(), memory=False, label=None):
+        self.enabled = True
+        self.label = label
+        self.trace_file = trace_file
+        self.profile = set(profile)
+        self.memory = memory
+        if memory:
+            tracemalloc.start()
+
+    def profiles(self, span):
+        # Only one profiler can be active, steps inside it are included
+        return not self.profiling and \
+            ("all" in self.profile or span.name in self.profile)
+
+    def profileFile(self, span):
+        base = os.path.splitext(self.trace_file)[0]
+        return "%s.%s.prof" % (base, span.path.replace("/", "."))
+
+    def resetPeak(self, span):
+        '''
+        tracemalloc keeps a single peak, so it is folded into the open span
+        before being reset for the next one
+        '''
+        (_, peak) = tracemalloc.get_traced_memory()
+        if span is not None:
+            span.peak = max(span.peak, peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def span(self, name):
+        parent = self.stack[-1] if self.stack else None
+        span = Span(name, parent.path + "/" + name if parent else name)
+        if not self.enabled:
+            yield span
+            return
+        (self.stack[-1].children if parent else self.roots).append(span)
+        self.stack.append(span)
+        profiler = cProfile.Profile() if self.profiles(span) else None
+        if self.memory:
+            self.resetPeak(parent)
+        begin = (time.perf_counter(), time.process_time(), maxRss())
+        if profiler is not None:
+            self.profiling = True
+            profiler.enable()
+        try:
+            yield span
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = False
+                profiler.dump_stats(self.profileFile(span))
+            rss = maxRss()
+            # The peak resident memory of a process can only grow, so a
+            # step is only told apart by how far it raised it
+            span.timings = {
+                "start_seconds": begin[0] - self.start,
+                "wall_seconds": time.perf_counter() - begin[0],
+                "cpu_seconds": time.process_time() - begin[1],
+                "process_max_rss_bytes": rss,
+                "max_rss_growth_bytes": rss - begin[2],
+            }
+            if self.memory:
+                self.resetPeak(span)
+                span.timings["peak_traced_bytes"] = span.peak
+                if parent is not None:
+                    parent.peak = max(parent.peak, span.peak)
+            self.stack.pop()
+            logging.info(
+                "%s took %.3fs (%.3fs CPU)" % (
+                    span.path, span.timings["wall_seconds"],
+                    span.timings["cpu_seconds"]
+                )
+            )
+
+    def record(self, name, **counters):
+        '''
+        Adds a step that was timed elsewhere, e.g. by parallel workers, to
+        the current span
+        '''
+        if not self.enabled:
+            return
+        parent = self.stack[-1] if self.stack else None
+        span = Span(name, parent.path + "/" + name if parent else name)
+        span.count(**counters)
+        (parent.children if parent else self.roots).append(span)
+
+    def save(self):
+        if not self.enabled:
+            return
+        with open(self.trace_file, "w") as tf:
+            json.dump(
+                {
+                    "label": self.label,
+                    "argv": sys.argv,
+                    "pid": os.getpid(),
+                    "spans": [span.toJson() for span in self.roots],
+                },
+                tf,
+                indent=2
+            )
+        logging.info("Trace written to %s" % (self.trace_file))
+
+
+# Tracer of this process, only enabled when a trace file is given
+tracer = Tracer()